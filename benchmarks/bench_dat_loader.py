@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+""" bench_dat_loader.py: compares the xmltodict DAT loader (convert_xml + create_dat_hash_dict)
+against the streaming loader (parse_dat_hashes), reporting wall time and peak RSS.
+
+usage: bench_dat_loader.py [datfile ...]
+       bench_dat_loader.py --games 50000
+
+each loader runs in a fresh process so the peak RSS of one doesn't hide the other
+"""
+import os
+import sys
+import time
+import random
+import hashlib
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.utils import convert_xml
+from modules.dat import create_dat_hash_dict, parse_dat_hashes
+import synthetic
+
+
+def write_synthetic_dat(path, games, tracks=3):
+    '''
+    writes a redump style dat with the requested number of games, each game has a
+    cue and a number of small random bin tracks
+    '''
+    rand = random.Random(games)
+    entries = []
+    for game in range(games):
+        name = f'Synthetic Game {game} (USA)'
+        entries.append((name, synthetic.rom_entries(synthetic.disc_files(rand, name, tracks, 16))))
+    synthetic.write_dat(path, 'redump', entries)
+
+
+def load_xmltodict(datfile):
+    raw_dat_dict = convert_xml(datfile)
+    return create_dat_hash_dict(raw_dat_dict['datafile'])
+
+
+def load_streaming(datfile):
+    return parse_dat_hashes(datfile)
+
+
+loaders = {'xmltodict' : load_xmltodict,
+           'iterparse' : load_streaming}
+
+
+def run_loader(loader, datfile, queue):
+    start = time.perf_counter()
+    keyresult, nameresult = loaders[loader](datfile)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak = peak // 1024
+    digest = hashlib.sha1(repr(sorted(keyresult.items())).encode('utf-8')).hexdigest()
+    queue.put((elapsed, peak, len(keyresult), len(nameresult), digest))
+
+
+def benchmark(datfile):
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for loader in loaders:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=run_loader, args=(loader, datfile, queue))
+        proc.start()
+        results[loader] = queue.get()
+        proc.join()
+    print(f'\n{os.path.basename(datfile)} ({os.path.getsize(datfile) / 2**20:.1f} MB)')
+    for loader, (elapsed, peak, keys, names, digest) in results.items():
+        print(f'  {loader:>10}: {elapsed:8.2f}s  peak RSS {peak / 1024:8.1f} MB  {keys} keys, {names} names')
+    digests = {result[4] for result in results.values()}
+    if len(digests) != 1:
+        print('  WARNING: loaders returned different lookup tables')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='DAT loader benchmark')
+    parser.add_argument('datfiles', nargs='*', help='DAT files to load, a synthetic DAT is used if none are given')
+    parser.add_argument('--games', type=int, default=20000, help='number of games in the synthetic DAT')
+    args = parser.parse_args()
+    if args.datfiles:
+        for datfile in args.datfiles:
+            benchmark(datfile)
+    else:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            datfile = os.path.join(temp_dir, 'synthetic.dat')
+            write_synthetic_dat(datfile, args.games)
+            benchmark(datfile)
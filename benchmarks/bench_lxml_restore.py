@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+""" bench_lxml_restore.py: compares putting lxml formatting changes back with one str.replace
+per change over the whole output against restore_lxml_formatting, checking that both give
+byte for byte identical output.
+
+usage: bench_lxml_restore.py [softlist.xml ...]
+       bench_lxml_restore.py --softwares 5000
+
+the softlist is round tripped through lxml as the softlist writers do, only the restore
+step is timed
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lxml import etree
+from modules.dat import get_lxml_replacements, restore_lxml_formatting
+
+
+def write_synthetic_softlist(path, softwares):
+    '''
+    writes a psx style softlist, every entry has quoted text in its description and
+    self closed tags with trailing whitespace as the MAME hash files do
+    '''
+    rand = random.Random(softwares)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<!DOCTYPE softwarelist SYSTEM "softwarelist.dtd">\n')
+        f.write('<softwarelist name="psx" description="Sony PlayStation CD-ROMs">\n')
+        for soft in range(softwares):
+            f.write(f'\t<software name="game{soft}">\n')
+            f.write(f'\t\t<description>Synthetic &quot;Game&quot; {soft} (USA)</description>\n')
+            f.write(f'\t\t<year>{rand.randint(1994, 2005)}</year>\n')
+            f.write(f'\t\t<publisher>Publisher {rand.randint(1, 200)}</publisher>\n')
+            f.write(f'\t\t<info name="serial" value="SLUS-{soft:05d}" />\n')
+            f.write(f'\t\t<info name="release" value="{rand.randint(19940101, 20051231)}" />\n')
+            f.write('\t\t<part name="cdrom" interface="psx_cdrom">\n')
+            f.write('\t\t\t<!--\n')
+            f.write(f'\t\t\t<rom name="Synthetic Game {soft} (USA).cue" size="{rand.randint(80, 2000)}" '
+                    f'crc="{rand.getrandbits(32):08x}" sha1="{rand.getrandbits(160):040x}"/>\n')
+            f.write('\t\t\t-->\n')
+            f.write('\t\t\t<diskarea name="cdrom">\n')
+            f.write(f'\t\t\t\t<disk name="synthetic game {soft} (usa)" sha1="{rand.getrandbits(160):040x}" />\n')
+            f.write('\t\t\t</diskarea>\n\t\t</part>\n\t</software>\n')
+        f.write('</softwarelist>\n')
+
+
+def lxml_output(softlist_xml_file):
+    parser = etree.XMLParser(remove_blank_text=False, strip_cdata=False)
+    tree = etree.parse(softlist_xml_file, parser)
+    return etree.tostring(
+        tree,
+        pretty_print=True,
+        xml_declaration=True,
+        encoding="UTF-8",
+        doctype='<!DOCTYPE softwarelist SYSTEM "softwarelist.dtd">'
+    ).decode("UTF-8")
+
+
+def restore_replace(output, lxml_changes):
+    # the restore loop the softlist writers used before restore_lxml_formatting
+    for old_string, new_string in lxml_changes.items():
+        output = output.replace(old_string, new_string)
+    return output
+
+
+def benchmark(softlist_xml_file):
+    lxml_changes = get_lxml_replacements(softlist_xml_file)
+    output = lxml_output(softlist_xml_file)
+    print(f'\n{os.path.basename(softlist_xml_file)} ({os.path.getsize(softlist_xml_file) / 2**20:.1f} MB, '
+          f'{len(lxml_changes)} changes)')
+    results = {}
+    for name, restore in (('replace', restore_replace), ('single pass', restore_lxml_formatting)):
+        start = time.perf_counter()
+        results[name] = restore(output, lxml_changes)
+        print(f'  {name:>12}: {time.perf_counter() - start:8.2f}s')
+    if results['replace'] != results['single pass']:
+        print('  WARNING: restored output differs')
+    else:
+        print('  restored output is identical')
+    with open(softlist_xml_file, 'r', encoding='utf-8') as f:
+        original = f.read()
+    # lxml rewrites the xml declaration with single quotes, everything else should match
+    unchanged = results['single pass'].split('\n', 1)[1] == original.split('\n', 1)[1]
+    print('  body matches the original file' if unchanged else '  body differs from the original file')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='lxml formatting restore benchmark')
+    parser.add_argument('softlists', nargs='*', help='softlist xml files, a synthetic softlist is used if none are given')
+    parser.add_argument('--softwares', type=int, default=5000, help='number of entries in the synthetic softlist')
+    args = parser.parse_args()
+    if args.softlists:
+        for softlist_xml_file in args.softlists:
+            benchmark(softlist_xml_file)
+    else:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            softlist_xml_file = os.path.join(temp_dir, 'psx.xml')
+            write_synthetic_softlist(softlist_xml_file, args.softwares)
+            benchmark(softlist_xml_file)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+""" bench_zip_extract.py: compares whole-member zip extraction (zip_file.read), a chunked
+streaming copy and extract_zip_member (streaming plus the copy_file_range path for stored
+members) as used by create_chd_from_zip, reporting throughput and peak RSS.
+
+usage: bench_zip_extract.py [--size-mb 512] [--buffer-kb 1024] [--dir /path/to/scratch]
+
+a stored and a deflated zip each holding a single synthetic track of --size-mb are
+built in the scratch directory, each extraction runs in a fresh process
+"""
+import os
+import sys
+import time
+import shutil
+import zipfile
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.chd import extract_zip_member
+
+
+def write_synthetic_zip(path, size, compression):
+    '''
+    writes a zip with one track of the requested size, each 2352 byte sector is half
+    repeated data and half random so deflate ratios are roughly those of real tracks
+    '''
+    block = os.urandom(1024)
+    with zipfile.ZipFile(path, 'w', compression) as zip_file:
+        with zip_file.open('Synthetic (Track 1).bin', 'w', force_zip64=True) as member:
+            written = 0
+            sector = 0
+            while written < size:
+                chunk = sector.to_bytes(4, 'little') * 76 + block + os.urandom(1024)
+                member.write(chunk)
+                written += len(chunk)
+                sector += 1
+
+
+def extract_read(zip_path, dest_dir, buffer_size):
+    with zipfile.ZipFile(zip_path, 'r') as zip_file:
+        for file_info in zip_file.infolist():
+            with open(os.path.join(dest_dir, file_info.filename), 'wb') as f:
+                f.write(zip_file.read(file_info.filename))
+
+
+def extract_streaming(zip_path, dest_dir, buffer_size):
+    with zipfile.ZipFile(zip_path, 'r') as zip_file:
+        for file_info in zip_file.infolist():
+            with zip_file.open(file_info) as source, open(os.path.join(dest_dir, file_info.filename), 'wb') as f:
+                shutil.copyfileobj(source, f, buffer_size)
+
+
+def extract_member(zip_path, dest_dir, buffer_size):
+    # streaming copy plus the kernel side copy for stored members
+    with zipfile.ZipFile(zip_path, 'r') as zip_file:
+        for file_info in zip_file.infolist():
+            extract_zip_member(zip_file, file_info, os.path.join(dest_dir, file_info.filename), buffer_size)
+
+
+methods = {'read' : extract_read,
+           'streaming' : extract_streaming,
+           'member' : extract_member}
+
+
+def run_method(method, zip_path, dest_dir, buffer_size, queue):
+    start = time.perf_counter()
+    methods[method](zip_path, dest_dir, buffer_size)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak = peak // 1024
+    queue.put((elapsed, peak))
+
+
+def benchmark(zip_path, scratch, buffer_size):
+    ctx = multiprocessing.get_context('spawn')
+    with zipfile.ZipFile(zip_path) as zip_file:
+        total = sum(file_info.file_size for file_info in zip_file.infolist())
+    print(f'\n{os.path.basename(zip_path)} ({total / 2**20:.0f} MB uncompressed, '
+          f'{os.path.getsize(zip_path) / 2**20:.0f} MB zipped)')
+    for method in methods:
+        with tempfile.TemporaryDirectory(dir=scratch) as dest_dir:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run_method, args=(method, zip_path, dest_dir, buffer_size, queue))
+            proc.start()
+            elapsed, peak = queue.get()
+            proc.join()
+        print(f'  {method:>10}: {elapsed:7.2f}s  {total / 2**20 / elapsed:8.1f} MB/s  peak RSS {peak / 1024:8.1f} MB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='zip extraction benchmark')
+    parser.add_argument('--size-mb', type=int, default=512, help='uncompressed track size')
+    parser.add_argument('--buffer-kb', type=int, default=1024, help='streaming copy buffer size')
+    parser.add_argument('--dir', default=None, help='scratch directory, defaults to the system temp dir')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(dir=args.dir) as scratch:
+        for name, compression in (('stored.zip', zipfile.ZIP_STORED), ('deflated.zip', zipfile.ZIP_DEFLATED)):
+            zip_path = os.path.join(scratch, name)
+            write_synthetic_zip(zip_path, args.size_mb * 2**20, compression)
+            benchmark(zip_path, scratch, args.buffer_kb * 1024)
+            os.remove(zip_path)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+""" check_equivalence.py: regression checks for the rewritten softlist and DAT paths, each
+new implementation is compared against the one it replaced.
+
+usage: check_equivalence.py [--entries 300]
+
+  dedup        remove_dupe_dat_entries against the earlier pairwise comparison, on the
+               redump/TOSEC/no-intro DATs of a synthetic platform
+  sha1 patch   update_softlist_chd_sha1s (in place) against update_softlist_chd_sha1s_lxml,
+               both must give the same xml and the in place output may only differ from the
+               original in the patched sha1 values.  the lxml writer also rewrites the xml
+               declaration and the spacing of patched tags so it isn't compared byte for byte
+  restore      restore_lxml_formatting against one str.replace per change
+
+the softlist fixture has comments, &amp; and &quot; entities, multi-part entries, a single
+disc entry patched through the cdrom1 alias and disk tags inside comments which must not
+be patched.  exits with 1 if any check fails
+"""
+import os
+import sys
+import copy
+import shutil
+import argparse
+import builtins
+import tempfile
+from lxml import etree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SOFTLIST_FIXTURE = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE softwarelist SYSTEM "softwarelist.dtd">
+<!--
+	header comment, <disk name="not a disk" sha1="1111111111111111111111111111111111111111" /> is left alone
+-->
+<softwarelist name="psx" description="Sony PlayStation CD-ROMs">
+	<software name="tomjerry">
+		<description>Tom &amp; Jerry &quot;Fists of Furry&quot; (USA)</description>
+		<year>2000</year>
+		<publisher>Ubi Soft &amp; VIS</publisher>
+		<info name="serial" value="SLUS-01234" />
+		<part name="cdrom" interface="psx_cdrom">
+			<!--
+			<rom name="Tom &amp; Jerry (USA).cue" size="97" crc="0a1b2c3d" sha1="2222222222222222222222222222222222222222"/>
+			<rom name="Tom &amp; Jerry (USA).bin" size="123456" crc="4e5f6a7b" sha1="3333333333333333333333333333333333333333"/>
+			<disk name="tom &amp; jerry (usa)" sha1="4444444444444444444444444444444444444444" />
+			-->
+			<diskarea name="cdrom">
+				<disk name="tom &amp; jerry (usa)" sha1="5555555555555555555555555555555555555555" />
+			</diskarea>
+		</part>
+	</software>
+	<software name="multi" cloneof="tomjerry">
+		<description>Multi &amp; Disc (USA)</description>
+		<year>1998</year>
+		<publisher>&lt;unknown&gt;</publisher>
+		<part name="cdrom1" interface="psx_cdrom">
+			<!-- <rom name="Multi (Disc 1).cue" size="90" crc="00000001" sha1="6666666666666666666666666666666666666666"/> -->
+			<diskarea name="cdrom">
+				<disk name="multi &amp; disc (usa) (disc 1)" sha1="7777777777777777777777777777777777777777" />
+			</diskarea>
+		</part>
+		<part name="cdrom2" interface="psx_cdrom">
+			<diskarea name="cdrom">
+				<disk name="multi &amp; disc (usa) (disc 2)" sha1="8888888888888888888888888888888888888888"/>
+			</diskarea>
+		</part>
+		<part name="cdrom3" interface="psx_cdrom">
+			<diskarea name="cdrom">
+				<disk name="multi &amp; disc (usa) (disc 3)" sha1="9999999999999999999999999999999999999999" />
+			</diskarea>
+		</part>
+	</software>
+	<software name="untouched">
+		<description>Untouched</description>
+		<year>1997</year>
+		<part name="cdrom" interface="psx_cdrom">
+			<diskarea name="cdrom">
+				<disk name="untouched" sha1="aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa" />
+			</diskarea>
+		</part>
+	</software>
+</softwarelist>
+'''
+
+# parts of the fixture in the softlist dict and their new sha1s, single disc entries use
+# the cdrom1 alias as the softlist dict does
+SHA1_EDITS = {'tomjerry' : {'cdrom1' : 'b' * 40},
+              'multi' : {'cdrom1' : 'c' * 40, 'cdrom2' : None, 'cdrom3' : 'd' * 40},
+              'untouched' : {'cdrom1' : None}}
+
+
+def remove_dupe_dat_entries_pairwise(platform_dat_dict):
+    '''
+    the dedup remove_dupe_dat_entries replaced, every source id of a non-redump dat is
+    looked up in every dat of another group
+    '''
+    for lookup_dat, lookup_hash_dict in platform_dat_dict['hashes'].items():
+        pop_list = []
+        dat_group = platform_dat_dict['dat_group'][lookup_dat]
+        if dat_group == 'redump':
+            continue
+        for source_id in lookup_hash_dict:
+            for dat, hash_dict in platform_dat_dict['hashes'].items():
+                if dat_group == platform_dat_dict['dat_group'][dat]:
+                    continue
+                if source_id in hash_dict:
+                    pop_list.append(source_id)
+        for to_delete in pop_list:
+            if to_delete in lookup_hash_dict:
+                lookup_hash_dict.pop(to_delete)
+
+
+def check_dedup(root, entries):
+    from modules.dat import build_dat_dict, remove_dupe_dat_entries
+    import synthetic
+    synthetic.write_platform(root, entries, tosec=0.4, no_intro=0.2)
+    dat_dict = {}
+    for datfile in synthetic.platform_settings(root)[synthetic.PLATFORM]:
+        build_dat_dict(datfile, dat_dict)
+    expected = copy.deepcopy(dat_dict)
+    remove_dupe_dat_entries_pairwise(expected)
+    removed = remove_dupe_dat_entries(dat_dict, quiet=True)
+    if not removed:
+        return 'the synthetic dats have no duplicates to remove'
+    if dat_dict['hashes'] != expected['hashes']:
+        return 'remaining dat entries differ from the pairwise dedup'
+    return None
+
+
+def soft_dict_for(edits):
+    return {soft : {'parts' : {part : {'new_sha1' : sha1} if sha1 else {} for part, sha1 in parts.items()}}
+            for soft, parts in edits.items()}
+
+
+def check_sha1_patch(root):
+    from modules.dat import update_softlist_chd_sha1s, update_softlist_chd_sha1s_lxml
+    original = os.path.join(root, 'fixture.xml')
+    with open(original, 'w', encoding='utf-8') as f:
+        f.write(SOFTLIST_FIXTURE)
+    outputs = {}
+    for name, update in (('in place', update_softlist_chd_sha1s), ('lxml', update_softlist_chd_sha1s_lxml)):
+        target = os.path.join(root, name.replace(' ', '_')+'.xml')
+        shutil.copyfile(original, target)
+        update(target, soft_dict_for(SHA1_EDITS))
+        with open(target, 'rb') as f:
+            outputs[name] = f.read()
+    canonical = {name : etree.tostring(etree.fromstring(output), method='c14n') for name, output in outputs.items()}
+    if canonical['in place'] != canonical['lxml']:
+        return 'in place output differs from the lxml writer'
+    with open(original, 'rb') as f:
+        expected = f.read()
+    # exactly the three disk sha1s change, nothing in comments and nothing else
+    for old, new in ((b'5' * 40, b'b' * 40), (b'7' * 40, b'c' * 40), (b'9' * 40, b'd' * 40)):
+        expected = expected.replace(b'sha1="'+old+b'" />', b'sha1="'+new+b'" />')
+    if outputs['in place'] != expected:
+        return 'bytes other than the patched sha1 values changed'
+    return None
+
+
+def check_restore(root):
+    from modules.dat import get_lxml_replacements, restore_lxml_formatting
+    from bench_lxml_restore import lxml_output, restore_replace
+    import synthetic
+    softlists = [os.path.join(root, 'fixture.xml'), os.path.join(root, 'hash', synthetic.PLATFORM+'.xml')]
+    for softlist_xml_file in softlists:
+        lxml_changes = get_lxml_replacements(softlist_xml_file)
+        output = lxml_output(softlist_xml_file)
+        restored = restore_lxml_formatting(output, lxml_changes)
+        if restored != restore_replace(output, lxml_changes):
+            return os.path.basename(softlist_xml_file)+': single pass restore differs from str.replace'
+        with open(softlist_xml_file, 'r', encoding='utf-8') as f:
+            original = f.read()
+        # lxml rewrites the xml declaration with single quotes, everything else should match
+        if restored.split('\n', 1)[1] != original.split('\n', 1)[1]:
+            return os.path.basename(softlist_xml_file)+': restored body differs from the original file'
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='softlist and DAT path regression checks')
+    parser.add_argument('--entries', type=int, default=300, help='softlist entries in the synthetic platform')
+    args = parser.parse_args()
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as root:
+        # the fingerprint cache lands in the scratch directory rather than the repo
+        builtins.script_dir = root
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        checks = (('dedup', lambda: check_dedup(root, args.entries)),
+                  ('sha1 patch', lambda: check_sha1_patch(root)),
+                  ('restore', lambda: check_restore(root)))
+        for name, check in checks:
+            error = check()
+            print(f'{name:<12} ' + ('ok' if not error else 'FAILED: '+error))
+            failures += bool(error)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+""" run_benchmarks.py: times the mapping pipeline stages on a synthetic platform and compares
+them with a stored baseline.
+
+usage: run_benchmarks.py [--entries 1000] [--baseline baseline.json] [--threshold 1.25]
+       run_benchmarks.py --entries 1000 --save-baseline baseline.json
+
+stages: build_sl_dict, build_dat_dict, remove_dupe_dat_entries, check_valid_zips,
+find_dat_matches and update_softlist_chd_sha1s.  the pipeline runs once for wall time
+and once under tracemalloc for peak memory, caches are written to a temp directory so
+every run is cold.  exits with 1 if a stage is slower than threshold x its baseline
+
+results are compared with benchmarks/baseline.json unless --baseline is given, it was
+recorded with the defaults (--entries 1000 --seed 1), refresh it with --save-baseline
+when a change is meant to move the numbers
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import builtins
+import platform
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+class StageTimer:
+    '''
+    runs each stage either timed or under tracemalloc and keeps the results
+    '''
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.results = {}
+
+    def run(self, stage, function, *args):
+        if self.memory:
+            tracemalloc.start()
+            result = function(*args)
+            self.results[stage] = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+        else:
+            start = time.perf_counter()
+            result = function(*args)
+            self.results[stage] = time.perf_counter() - start
+        return result
+
+
+def run_pipeline(root, memory=False):
+    '''
+    runs every stage once against the synthetic platform under root
+    modules are imported here so the cache directory points at the scratch directory
+    '''
+    from modules import cache, chd, utils
+    from modules.dat import build_sl_dict, build_dat_dict, remove_dupe_dat_entries, update_softlist_chd_sha1s
+    import slupdate
+    import synthetic
+    cache.cache_dir = os.path.join(root, 'cache')
+    shutil.rmtree(cache.cache_dir, ignore_errors=True)
+    settings = synthetic.platform_settings(root)
+    slupdate.settings.clear()
+    slupdate.settings.update(settings)
+    platform_name = synthetic.PLATFORM
+    softlist_xml_file = os.path.join(settings['sl_dir'], platform_name+'.xml')
+    timer = StageTimer(memory)
+
+    def load_softlist():
+        sl_dict = {}
+        build_sl_dict(utils.convert_xml(softlist_xml_file, comments=True)['softwarelist']['software'], sl_dict)
+        return sl_dict
+
+    def load_dats():
+        dat_dict = {}
+        for datfile in settings[platform_name]:
+            build_dat_dict(datfile, dat_dict)
+        return dat_dict
+
+    def check_zips(dat_dict):
+        valid = 0
+        for datfile, hashes in dat_dict['hashes'].items():
+            for key, dat_entry in hashes.items():
+                if key[1] == 'sha1' and chd.check_valid_zips(dat_entry, settings[platform_name][datfile]):
+                    valid += 1
+        return valid
+
+    def find_matches(sl_dict, dat_dict):
+        # match against a cold zip cache so zip verification is part of the stage
+        utils.reset_dir_index()
+        chd.zip_cache.clear()
+        return slupdate.find_dat_matches(platform_name, sl_dict, dat_dict, quiet=True)
+
+    def write_sha1s(sl_dict):
+        # a copy of the softlist is patched, one part in a hundred gets a new hash
+        target = softlist_xml_file+'.bench'
+        shutil.copyfile(softlist_xml_file, target)
+        for number, soft_data in enumerate(sl_dict.values()):
+            if number % 100 == 0:
+                for part_data in soft_data['parts'].values():
+                    part_data['new_sha1'] = 'f' * 40
+        update_softlist_chd_sha1s(target, sl_dict)
+        os.remove(target)
+
+    sl_dict = timer.run('build_sl_dict', load_softlist)
+    dat_dict = timer.run('build_dat_dict', load_dats)
+    timer.run('remove_dupe_dat_entries', remove_dupe_dat_entries, dat_dict)
+    utils.reset_dir_index()
+    chd.zip_cache.clear()
+    timer.run('check_valid_zips', check_zips, dat_dict)
+    summary = timer.run('find_dat_matches', find_matches, sl_dict, dat_dict)
+    timer.run('update_softlist_chd_sha1s', write_sha1s, sl_dict)
+    return timer.results, summary
+
+
+def compare(results, baseline, threshold):
+    '''
+    prints each stage against the baseline, returns the stages slower than threshold x
+    '''
+    regressions = []
+    print(f"\n{'stage':<28}{'seconds':>10}{'baseline':>10}{'ratio':>8}{'peak MB':>10}{'baseline':>10}")
+    for stage, result in results['stages'].items():
+        base = baseline['stages'].get(stage) if baseline else None
+        if base:
+            ratio = result['seconds'] / base['seconds'] if base['seconds'] else 1
+            flag = '  <-- slower' if ratio > threshold else ''
+            if flag:
+                regressions.append(stage)
+            print(f"{stage:<28}{result['seconds']:>10.3f}{base['seconds']:>10.3f}{ratio:>8.2f}"
+                  f"{result['peak_mb']:>10.1f}{base['peak_mb']:>10.1f}{flag}")
+        else:
+            print(f"{stage:<28}{result['seconds']:>10.3f}{'':>10}{'':>8}{result['peak_mb']:>10.1f}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='mapping pipeline benchmarks')
+    parser.add_argument('--entries', type=int, default=1000, help='softlist entries in the synthetic platform')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', default=BASELINE, help='baseline json to compare against, defaults to baseline.json')
+    parser.add_argument('--save-baseline', help='write the results to this json file')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio reported as a regression')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--dir', default=None, help='scratch directory, defaults to the system temp dir')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as root:
+        # cache and settings files land in the scratch directory rather than the repo
+        builtins.script_dir = root
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import synthetic
+        start = time.perf_counter()
+        counts = synthetic.write_platform(root, args.entries, args.seed)
+        print(f"generated {counts['entries']} entries, {counts['discs']} discs, {counts['zips']} zips "
+              f"in {time.perf_counter() - start:.1f}s")
+        seconds, summary = run_pipeline(root)
+        peaks = {}
+        if not args.no_memory:
+            peaks, summary = run_pipeline(root, memory=True)
+
+    results = {'entries' : args.entries,
+               'seed' : args.seed,
+               'python' : platform.python_version(),
+               'summary' : {key : value for key, value in summary.items() if key != 'source_stats'},
+               'stages' : {stage : {'seconds' : seconds[stage], 'peak_mb' : peaks.get(stage, 0.0)}
+                           for stage in seconds}}
+    baseline = None
+    if args.baseline and (args.baseline != BASELINE or os.path.exists(BASELINE)):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline['entries'] != args.entries or baseline['seed'] != args.seed:
+            print('baseline was recorded with different --entries or --seed, ratios are not comparable')
+    regressions = compare(results, baseline, args.threshold)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1)
+    if regressions:
+        print(f"\n{len(regressions)} stage(s) slower than {args.threshold}x the baseline: {', '.join(regressions)}")
+        sys.exit(1)
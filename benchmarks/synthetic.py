@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+""" synthetic.py: writes a reproducible synthetic platform for the benchmarks, a softlist with
+source rom comments, redump, TOSEC and no-intro style DATs and the matching zip trees.
+
+usage: synthetic.py root [--entries 1000] [--seed 1]
+
+the layout under root is the one slupdate expects for a configured platform:
+  hash/psx.xml, dats/<group>/<group>.dat, roms/<group>/<game>.zip, chd/ and temp/
+platform_settings() returns the settings dict for it
+"""
+import os
+import zlib
+import random
+import hashlib
+import zipfile
+import argparse
+
+PLATFORM = 'psx'
+
+DAT_GROUPS = {'redump' : 'http://redump.org/',
+              'tosec' : 'https://www.tosecdev.org/',
+              'no-intro' : 'https://www.no-intro.org/'}
+
+
+def random_bytes(rand, size):
+    return rand.getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def disc_files(rand, name, tracks, track_bytes):
+    '''
+    returns the (filename, data) list for one disc, a cue followed by its bin tracks
+    '''
+    bins = [(f'{name} (Track {track}).bin', random_bytes(rand, track_bytes + rand.randint(0, track_bytes)))
+            for track in range(1, tracks + 1)]
+    cue = ''.join(f'FILE "{filename}" BINARY\n  TRACK {track:02d} MODE2/2352\n    INDEX 01 00:00:00\n'
+                  for track, (filename, data) in enumerate(bins, 1)).encode('utf-8')
+    return [(f'{name}.cue', cue)] + bins
+
+
+def rom_entries(files):
+    return [(filename, len(data), f'{zlib.crc32(data):08x}', hashlib.sha1(data).hexdigest())
+            for filename, data in files]
+
+
+def plan_entries(entries, seed=1, multi_disc=0.1, crc_only=0.05, tosec=0.2, no_intro=0.05,
+                 missing=0.05, bad_zip=0.05, no_source=0.05):
+    '''
+    decides what each softlist entry looks like, returns a list of entry dicts
+    groups lists the dats a disc is in, a disc in redump and TOSEC exercises the dedup
+    '''
+    rand = random.Random(seed)
+    plan = []
+    for number in range(entries):
+        roll = rand.random()
+        if roll < tosec:
+            groups = ['tosec'] if rand.random() < 0.5 else ['redump', 'tosec']
+        elif roll < tosec + no_intro:
+            groups = ['no-intro']
+        else:
+            groups = ['redump']
+        plan.append({'soft' : f'game{number}',
+                     'name' : f'Synthetic Game {number} (USA)',
+                     'discs' : rand.randint(2, 4) if rand.random() < multi_disc else 1,
+                     'crc_only' : rand.random() < crc_only,
+                     'source' : rand.random() >= no_source,
+                     'missing' : rand.random() < missing,
+                     'bad_zip' : rand.random() < bad_zip,
+                     'groups' : groups})
+    return plan
+
+
+def write_platform(root, entries, seed=1, tracks=2, track_bytes=256, **options):
+    '''
+    writes the softlist, dats and zips for a synthetic platform under root
+    returns a counts dict describing what was written
+    '''
+    for directory in ['hash', 'chd', 'temp'] + [os.path.join(kind, group) for kind in ('dats', 'roms') for group in DAT_GROUPS]:
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+    rand = random.Random(seed)
+    dats = {group : [] for group in DAT_GROUPS}
+    counts = {'entries':entries, 'discs':0, 'zips':0, 'bad_zips':0, 'missing_zips':0}
+    with open(os.path.join(root, 'hash', PLATFORM+'.xml'), 'w', encoding='utf-8') as sl:
+        sl.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        sl.write('<!DOCTYPE softwarelist SYSTEM "softwarelist.dtd">\n')
+        sl.write(f'<softwarelist name="{PLATFORM}" description="Synthetic CD-ROMs">\n')
+        for entry in plan_entries(entries, seed, **options):
+            sl.write(f'\t<software name="{entry["soft"]}">\n')
+            sl.write(f'\t\t<description>{entry["name"]} &quot;Synthetic&quot;</description>\n')
+            sl.write(f'\t\t<year>{rand.randint(1994, 2005)}</year>\n')
+            sl.write(f'\t\t<info name="serial" value="SLUS-{rand.randint(0, 99999):05d}" />\n')
+            for disc in range(1, entry['discs'] + 1):
+                counts['discs'] += 1
+                part = 'cdrom' if entry['discs'] == 1 else f'cdrom{disc}'
+                name = entry['name'] + ('' if entry['discs'] == 1 else f' (Disc {disc})')
+                files = disc_files(rand, name, tracks, track_bytes)
+                roms = rom_entries(files)
+                sl.write(f'\t\t<part name="{part}" interface="psx_cdrom">\n')
+                if entry['source']:
+                    sl.write('\t\t\t<!--\n')
+                    for filename, size, crc, sha1 in roms:
+                        hashes = f'crc="{crc}"' if entry['crc_only'] else f'crc="{crc}" sha1="{sha1}"'
+                        sl.write(f'\t\t\t<rom name="{filename}" size="{size}" {hashes}/>\n')
+                    sl.write('\t\t\t-->\n')
+                sl.write('\t\t\t<diskarea name="cdrom">\n')
+                sl.write(f'\t\t\t\t<disk name="{name.lower()}" sha1="{random_bytes(rand, 20).hex()}" />\n')
+                sl.write('\t\t\t</diskarea>\n\t\t</part>\n')
+                for group in entry['groups']:
+                    dats[group].append((name, roms))
+                    if entry['missing']:
+                        counts['missing_zips'] += 1
+                        continue
+                    write_zip(os.path.join(root, 'roms', group, name+'.zip'), files, entry['bad_zip'])
+                    counts['zips'] += 1
+                    counts['bad_zips'] += entry['bad_zip']
+            sl.write('\t</software>\n')
+        sl.write('</softwarelist>\n')
+    for group, games in dats.items():
+        write_dat(os.path.join(root, 'dats', group, group+'.dat'), group, games)
+    return counts
+
+
+def write_zip(zip_path, files, bad=False):
+    '''
+    a bad zip has its last track truncated so the crc check fails
+    '''
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zip_file:
+        for filename, data in files:
+            if bad and filename == files[-1][0]:
+                data = data[:-1]
+            zip_file.writestr(filename, data)
+
+
+def write_dat(path, group, games):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0"?>\n')
+        f.write('<!DOCTYPE datafile PUBLIC "-//Logiqx//DTD ROM Management Datafile//EN" "http://www.logiqx.com/Dats/datafile.dtd">\n')
+        f.write(f'<datafile>\n\t<header>\n\t\t<name>Synthetic - PlayStation ({group})</name>\n')
+        f.write(f'\t\t<url>{DAT_GROUPS[group]}</url>\n\t</header>\n')
+        for name, roms in games:
+            f.write(f'\t<game name="{name}">\n\t\t<category>Games</category>\n')
+            f.write(f'\t\t<description>{name}</description>\n')
+            for filename, size, crc, sha1 in roms:
+                f.write(f'\t\t<rom name="{filename}" size="{size}" crc="{crc}" sha1="{sha1}"/>\n')
+            f.write('\t</game>\n')
+        f.write('</datafile>\n')
+
+
+def platform_settings(root):
+    '''
+    returns the slupdate settings for the synthetic platform, dats in priority order
+    '''
+    return {'sl_dir' : os.path.join(root, 'hash'),
+            'chd' : os.path.join(root, 'chd'),
+            'zip_temp' : os.path.join(root, 'temp'),
+            'romvault' : False,
+            PLATFORM : {os.path.join(root, 'dats', group, group+'.dat') : os.path.join(root, 'roms', group)
+                        for group in DAT_GROUPS}}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='synthetic benchmark data generator')
+    parser.add_argument('root', help='directory to write the platform to')
+    parser.add_argument('--entries', type=int, default=1000, help='number of softlist entries')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    print(write_platform(args.root, args.entries, args.seed))
@@ -0,0 +1,157 @@
+import os
+import json
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from modules.cache import cache_dir, write_cache_entry
+from modules.chd import read_chd_header, ChdHeaderError
+from modules.dat import load_sl_dict
+
+
+'''
+CHD library audit functions, compares the CHDs under the CHD destination directory
+against the sha1s in the software lists without building anything
+'''
+# sha1s read from existing chds, keyed on path and only trusted while size/mtime match
+AUDIT_CACHE_VERSION = 1
+audit_cache_path = os.path.join(cache_dir, 'audit.cache')
+audit_cache = {}
+audit_cache_lock = threading.Lock()
+
+
+def load_audit_cache():
+    audit_cache.clear()
+    try:
+        with open(audit_cache_path, 'rb') as f:
+            saved = pickle.load(f)
+    except:
+        return
+    if saved.get('version') == AUDIT_CACHE_VERSION:
+        audit_cache.update(saved['chds'])
+
+
+def save_audit_cache():
+    try:
+        write_cache_entry(audit_cache_path, {'version':AUDIT_CACHE_VERSION, 'chds':audit_cache})
+    except (OSError, pickle.PicklingError) as e:
+        print('unable to save the audit cache: '+str(e))
+
+
+def list_platform_chds(platform_dir):
+    '''
+    returns a (soft, chd filename without extension) -> path dict for every chd under
+    the platform directory, one level of softlist entry directories is expected, and a
+    soft -> (path, error) dict of the entry directories which couldn't be listed
+    '''
+    chds = {}
+    unreadable = {}
+    try:
+        with os.scandir(platform_dir) as entries:
+            soft_dirs = [entry for entry in entries if entry.is_dir()]
+    except OSError:
+        return chds, unreadable
+    for soft_dir in soft_dirs:
+        try:
+            with os.scandir(soft_dir.path) as entries:
+                for entry in entries:
+                    if entry.name.lower().endswith('.chd') and entry.is_file():
+                        chds[(soft_dir.name, entry.name[:-4])] = entry.path
+        except OSError as e:
+            unreadable[soft_dir.name] = (soft_dir.path, str(e))
+    return chds, unreadable
+
+
+def read_cached_chd_sha1(chd_path):
+    '''
+    returns (sha1, error) for a chd, the header is only read if the file is new or has
+    changed size or mtime since it was last audited
+    '''
+    try:
+        stat = os.stat(chd_path)
+    except OSError as e:
+        return None, str(e)
+    with audit_cache_lock:
+        cached = audit_cache.get(chd_path)
+    if cached and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+        return cached['sha1'], cached['error']
+    try:
+        sha1, error = read_chd_header(chd_path)['sha1'], None
+    except (ChdHeaderError, OSError) as e:
+        sha1, error = None, str(e)
+    with audit_cache_lock:
+        audit_cache[chd_path] = {'size':stat.st_size, 'mtime_ns':stat.st_mtime_ns, 'sha1':sha1, 'error':error}
+    return sha1, error
+
+
+def audit_platform(platform, sl_dict, platform_dir, executor):
+    '''
+    compares the chds found for a platform against its softlist dict
+    returns the matching, mismatching, missing, orphaned and unreadable lists, entry
+    directories which can't be listed are unreadable and their chds aren't missing
+    '''
+    result = {'matching':[], 'mismatching':[], 'missing':[], 'orphaned':[], 'unreadable':[]}
+    chds, unreadable_dirs = list_platform_chds(platform_dir)
+    for soft, (path, error) in unreadable_dirs.items():
+        result['unreadable'].append({'soft':soft, 'path':path, 'error':error})
+    # forget cached sha1s for chds which have been removed from this platform
+    present = set(chds.values())
+    with audit_cache_lock:
+        for chd_path in [path for path in audit_cache if path.startswith(platform_dir+os.sep) and path not in present]:
+            audit_cache.pop(chd_path)
+    sha1s = dict(zip(chds, executor.map(read_cached_chd_sha1, chds.values())))
+    expected = set()
+    for soft, soft_data in sl_dict.items():
+        for part, part_data in soft_data['parts'].items():
+            if 'chd_filename' not in part_data:
+                continue
+            key = (soft, part_data['chd_filename'])
+            expected.add(key)
+            entry = {'soft':soft, 'part':part, 'chd':part_data['chd_filename']+'.chd',
+                     'softlist_sha1':part_data.get('chd_sha1')}
+            if soft in unreadable_dirs:
+                continue
+            if key not in chds:
+                result['missing'].append(entry)
+                continue
+            sha1, error = sha1s[key]
+            entry['path'] = chds[key]
+            if error:
+                entry['error'] = error
+                result['unreadable'].append(entry)
+            elif sha1 == entry['softlist_sha1']:
+                result['matching'].append(entry)
+            else:
+                entry['chd_sha1'] = sha1
+                result['mismatching'].append(entry)
+    for key, chd_path in chds.items():
+        if key not in expected:
+            sha1, error = sha1s[key]
+            result['orphaned'].append({'soft':key[0], 'chd':key[1]+'.chd', 'path':chd_path, 'chd_sha1':sha1})
+    return result
+
+
+def audit_chd_library(settings, platforms, report_path, workers=8):
+    '''
+    audits every platform with a chd directory in one pass, reading chd sha1s with a
+    pool of workers.  the report is written to report_path as json and returned
+    '''
+    load_audit_cache()
+    report = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for platform in platforms:
+            platform_dir = os.path.join(settings['chd'], platform)
+            softlist_xml_file = os.path.join(settings['sl_dir'], platform+'.xml')
+            if not os.path.isdir(platform_dir) or not os.path.isfile(softlist_xml_file):
+                continue
+            print('auditing '+platform+' CHDs')
+            report[platform] = audit_platform(platform, load_sl_dict(softlist_xml_file), platform_dir, executor)
+    save_audit_cache()
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1)
+    return report
+
+
+def print_audit_summary(report):
+    for platform, result in report.items():
+        counts = ', '.join(f'{len(entries)} {category}' for category, entries in result.items())
+        print(f'  {platform}: {counts}')
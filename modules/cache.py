@@ -0,0 +1,116 @@
+import os
+import pickle
+import hashlib
+import builtins
+
+# cache entries are stored alongside the settings in the script directory
+if hasattr(builtins, "script_dir"):
+    script_dir = builtins.script_dir
+else:
+    script_dir = os.getcwd()
+
+cache_dir = os.path.join(script_dir, 'cache')
+
+
+def file_signature(path):
+    '''
+    returns the (size, mtime) tuple used to decide whether a file has changed
+    '''
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+def file_sha1(path, buffer_size=1024*1024):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(buffer_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def cache_entry_path(kind, source_path):
+    '''
+    each source file gets its own cache file named after the sha1 of its path
+    kind is the cache subdirectory, e.g. 'dats'
+    '''
+    name = hashlib.sha1(source_path.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, kind, name+'.cache')
+
+def write_cache_entry(entry_path, entry):
+    # write to a temp file first so an interrupted write never leaves a truncated entry
+    os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+    temp_path = entry_path+'.tmp'
+    with open(temp_path, 'wb') as f:
+        pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, entry_path)
+
+def evict_cache_entry(entry_path):
+    try:
+        os.remove(entry_path)
+    except OSError:
+        pass
+
+def load_file_cache(kind, source_path, version):
+    '''
+    returns the data cached for source_path, or None if there is no usable entry
+    entries are reused when size and mtime are unchanged, if only the mtime changed the
+    content sha1 is checked before reusing it.  entries from another cache version or
+    for changed content are evicted
+    '''
+    entry_path = cache_entry_path(kind, source_path)
+    try:
+        with open(entry_path, 'rb') as f:
+            entry = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        evict_cache_entry(entry_path)
+        return None
+    if entry.get('version') != version or entry.get('path') != source_path:
+        evict_cache_entry(entry_path)
+        return None
+    try:
+        size, mtime = file_signature(source_path)
+    except OSError:
+        evict_cache_entry(entry_path)
+        return None
+    if entry['size'] == size and entry['mtime_ns'] == mtime:
+        return entry['data']
+    if entry['size'] == size and file_sha1(source_path) == entry['sha1']:
+        # touched but not changed, refresh the mtime so the hash isn't needed next time
+        entry['mtime_ns'] = mtime
+        try:
+            write_cache_entry(entry_path, entry)
+        except OSError:
+            pass
+        return entry['data']
+    evict_cache_entry(entry_path)
+    return None
+
+def store_file_cache(kind, source_path, version, data, signature):
+    '''
+    stores data built from source_path, signature is the file_signature taken before
+    the source was parsed.  nothing is stored if the file changed in the meantime
+    '''
+    sha1 = file_sha1(source_path)
+    if file_signature(source_path) != signature:
+        return
+    entry = {
+        'version' : version,
+        'path' : source_path,
+        'size' : signature[0],
+        'mtime_ns' : signature[1],
+        'sha1' : sha1,
+        'data' : data
+    }
+    write_cache_entry(cache_entry_path(kind, source_path), entry)
+
+def prune_file_cache(kind, source_paths):
+    '''
+    deletes cache entries for any source file that isn't in source_paths
+    '''
+    kind_dir = os.path.join(cache_dir, kind)
+    if not os.path.isdir(kind_dir):
+        return
+    keep = {os.path.basename(cache_entry_path(kind, path)) for path in source_paths}
+    for entry in os.listdir(kind_dir):
+        if entry not in keep:
+            evict_cache_entry(os.path.join(kind_dir, entry))
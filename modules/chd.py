@@ -1,14 +1,32 @@
 import pathlib
 import re
 import os
+import sys
+import zlib
+import json
+import struct
+import pickle
+import hashlib
 import shutil
+import time
 import subprocess
 import tempfile
 import zipfile
 import logging
 import builtins
+import threading
 import inquirer
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    # not available on windows, reflinks are skipped
+    fcntl = None
 from distutils.version import LooseVersion
+from modules.cache import cache_dir, write_cache_entry
+from modules.utils import indexed_stat
+from modules.ledger import source_fingerprint
+from modules.profiling import stage
 
 # get the script directory for chdman
 if hasattr(builtins, "script_dir"):
@@ -20,33 +38,114 @@ else:
 # set environment to include script directory directory in addition to path - for chdman placed with script
 env_with_script_dir = {**os.environ, 'PATH': script_dir + ':' + os.environ['PATH']}
 
+# member crc tables and verdicts for checked zips, keyed on zip path and only
+# trusted while the zip size and mtime are unchanged
+ZIP_CACHE_VERSION = 1
+zip_cache_path = os.path.join(cache_dir, 'zips.cache')
+zip_cache = {}
+zip_cache_stats = {'hits':0, 'misses':0, 'invalidations':0}
+zip_cache_lock = threading.Lock()
+# zip paths checked since the cache was loaded, see save_zip_cache
+zip_cache_used = set()
+
+# chunk size for copying zip members to the temp directory
+EXTRACT_BUFFER_SIZE = 1024*1024
+
+# size of the CHD v5 header, everything read_chd_header needs is in it
+CHD_V5_HEADER_SIZE = 124
+
+# estimated chd size as a fraction of the extracted tracks, used to reserve space
+CHD_SIZE_RATIO = 0.75
+
+# builds slower than this (MB/s of extracted input) are flagged in the build report
+SLOW_BUILD_MBPS = 2
+SLOW_BUILD_MIN_BYTES = 64*1024*1024
+
+# lines of chdman output kept to explain a failed build
+CHDMAN_TAIL_LINES = 10
+# chdman progress is printed every CHDMAN_PROGRESS_STEP percent or CHDMAN_PROGRESS_SECONDS
+CHDMAN_PROGRESS_STEP = 5
+CHDMAN_PROGRESS_SECONDS = 10
+
+# linux ioctls used to reflink a range of one file, or a whole file, into another
+FICLONERANGE = 0x4020940d
+FICLONE = 0x40049409
+
+# bump when the chdman parameters change so older store entries are no longer used
+CHD_STORE_VERSION = 1
+
+# one lock per store key so the same source is never built twice at once
+store_locks = {}
+store_locks_lock = threading.Lock()
+
+# serialises interactive prompts from parallel chd builds
+prompt_lock = threading.Lock()
+
 def is_greater_than_0_176(version_string):
     return LooseVersion(version_string) > LooseVersion('0.176')
 
+class ChdHeaderError(Exception):
+    '''
+    raised when a file isn't a CHD or uses a header version slupdate can't read
+    '''
+    pass
+
+
+def read_chd_header(chd_path):
+    '''
+    reads the fixed CHD v5 header without starting chdman, only the first 124 bytes
+    of the file are read.  returns a dict with the version, header length, compressor
+    codecs, logical size, map/metadata offsets, hunk and unit sizes and the raw,
+    combined and parent sha1s (parent_sha1 is None for CHDs without a parent)
+    raises ChdHeaderError for other files or CHD versions, older CHDs need to be
+    upgraded with 'chdman copy' before their hashes will match MAME softlists
+    '''
+    with open(chd_path, 'rb') as f:
+        header = f.read(CHD_V5_HEADER_SIZE)
+    if len(header) < 16 or header[:8] != b'MComprHD':
+        raise ChdHeaderError(chd_path+' is not a CHD file')
+    length, version = struct.unpack('>II', header[8:16])
+    if version != 5:
+        raise ChdHeaderError(f'{chd_path} is a version {version} CHD, only version 5 is supported')
+    if len(header) < CHD_V5_HEADER_SIZE or length < CHD_V5_HEADER_SIZE:
+        raise ChdHeaderError(chd_path+' has a truncated CHD header')
+    compressors = []
+    for offset in range(16, 32, 4):
+        codec = header[offset:offset+4]
+        if codec != b'\x00\x00\x00\x00':
+            compressors.append(codec.decode('ascii', errors='replace'))
+    logical_bytes, map_offset, meta_offset, hunk_bytes, unit_bytes = struct.unpack('>QQQII', header[32:64])
+    parent_sha1 = header[104:124]
+    return {'version' : version,
+            'length' : length,
+            'compressors' : compressors,
+            'logical_bytes' : logical_bytes,
+            'map_offset' : map_offset,
+            'meta_offset' : meta_offset,
+            'hunk_bytes' : hunk_bytes,
+            'unit_bytes' : unit_bytes,
+            'raw_sha1' : header[64:84].hex(),
+            'sha1' : header[84:104].hex(),
+            'parent_sha1' : parent_sha1.hex() if any(parent_sha1) else None}
+
+
 def chdman_info(chd=None):
     '''
-    returns the data sha1 if a CHD path is provided
-    otherwise returns chdman version
+    returns the sha1 if a CHD path is provided, read directly from the CHD header
+    otherwise returns chdman version, or None if chdman can't be run
     '''
     if chd:
-        command = ['chdman', 'info', '-i', chd]
-    else:
-        command = 'chdman'
-    proc = subprocess.Popen(command, stdout=subprocess.PIPE, env=env_with_script_dir)
+        return read_chd_header(chd)['sha1']
+    command = 'chdman'
     try:
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, env=env_with_script_dir)
         output = proc.stdout.read().decode('ascii').split('\n')
-    except:
-        logging.debug(f'chdman not in the system path or installed with slupdate, possibly corrupted CHD\n'+chd)
-        pass
-    if chd:
-        for line in output:
-            if re.findall(r'^\s*SHA1', line):
-                info = re.sub(r'\s*SHA1:\s*','',line).strip()
-                #info = re.sub(r'\s*Data\sSHA1:\s*','',line)
-                break
-    else:
-        info = re.findall(r'\d+\.\d+',output[0])[0] # return version
-    return info
+        proc.wait()
+    except (OSError, UnicodeDecodeError):
+        logging.debug(f'chdman not in the system path or installed with slupdate')
+        return None
+    info = re.findall(r'\d+\.\d+',output[0]) # return version
+    return info[0] if info else None
 
 # no-intro cuesheets don't match filenames, need to update names before passing to chdman
 def parse_cue_sheet(cue_file_path):
@@ -57,24 +156,134 @@ def parse_cue_sheet(cue_file_path):
     return file_entries
 
 
-def extract_zip_to_tempdir(zip_path):
+def zip_member_data_offset(zip_fd, file_info):
+    '''
+    returns the offset of a member's data in the archive, the local file header has
+    its own name and extra field lengths which can differ from the central directory
+    '''
+    header = os.pread(zip_fd, 30, file_info.header_offset)
+    if len(header) != 30 or header[:4] != b'PK\x03\x04':
+        raise zipfile.BadZipFile('Bad local file header for '+file_info.filename)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return file_info.header_offset + 30 + name_length + extra_length
+
+
+def clone_file_range(src_fd, src_offset, dest_fd, length):
+    '''
+    reflinks a block aligned range from src_fd to the start of dest_fd (btrfs/xfs)
+    returns the number of bytes cloned, 0 if the filesystem can't clone the range
+    '''
+    if not hasattr(fcntl, 'ioctl') or not sys.platform.startswith('linux'):
+        return 0
+    block_size = os.fstat(src_fd).st_blksize
+    length -= length % block_size
+    if src_offset % block_size or not length:
+        return 0
+    try:
+        fcntl.ioctl(dest_fd, FICLONERANGE, struct.pack('qQQQ', src_fd, src_offset, length, 0))
+    except OSError:
+        return 0
+    return length
+
+
+def copy_file_range_to(src_fd, src_offset, dest_fd, dest_offset, length):
+    '''
+    copies a byte range between files inside the kernel, using copy_file_range or
+    sendfile when available and falling back to pread/write
+    '''
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < length:
+                count = os.copy_file_range(src_fd, dest_fd, length - copied,
+                                           src_offset + copied, dest_offset + copied)
+                if count == 0:
+                    break
+                copied += count
+        except OSError:
+            pass
+    if copied < length and hasattr(os, 'sendfile'):
+        try:
+            os.lseek(dest_fd, dest_offset + copied, os.SEEK_SET)
+            while copied < length:
+                count = os.sendfile(dest_fd, src_fd, src_offset + copied, length - copied)
+                if count == 0:
+                    break
+                copied += count
+        except OSError:
+            pass
+    while copied < length:
+        chunk = os.pread(src_fd, min(EXTRACT_BUFFER_SIZE, length - copied), src_offset + copied)
+        if not chunk:
+            raise zipfile.BadZipFile('Truncated zip member')
+        os.pwrite(dest_fd, chunk, dest_offset + copied)
+        copied += len(chunk)
+
+
+def file_crc32(file_path, buffer_size=EXTRACT_BUFFER_SIZE):
+    crc = 0
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(buffer_size), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def copy_stored_member(zip_path, file_info, file_path):
+    '''
+    copies an uncompressed member's bytes straight from the archive without passing
+    them through python, block aligned data is reflinked where the filesystem allows
+    the crc of the copy is checked against the zip's central directory
+    '''
+    with open(zip_path, 'rb') as zip_f, open(file_path, 'wb') as f:
+        zip_fd = zip_f.fileno()
+        data_offset = zip_member_data_offset(zip_fd, file_info)
+        length = file_info.file_size
+        cloned = clone_file_range(zip_fd, data_offset, f.fileno(), length)
+        copy_file_range_to(zip_fd, data_offset + cloned, f.fileno(), cloned, length - cloned)
+    if file_crc32(file_path) != file_info.CRC:
+        raise zipfile.BadZipFile('Bad CRC-32 for file '+file_info.filename)
+
+
+def extract_zip_member(zip_file, file_info, file_path, buffer_size=EXTRACT_BUFFER_SIZE):
+    '''
+    copies a zip member to file_path in buffer_size chunks so memory use doesn't depend
+    on the track size, the member crc is still checked by zipfile once the copy completes
+    stored members are copied with copy_stored_member when the zip was opened by path
+    '''
+    stored = (file_info.compress_type == zipfile.ZIP_STORED and not file_info.flag_bits & 0x1
+              and isinstance(zip_file.filename, str) and file_info.compress_size == file_info.file_size)
+    if stored:
+        try:
+            copy_stored_member(zip_file.filename, file_info, file_path)
+            return
+        except OSError:
+            # fall back to the normal path, which rewrites the file from the start
+            pass
+    with zip_file.open(file_info) as source, open(file_path, 'wb') as f:
+        shutil.copyfileobj(source, f, buffer_size)
+
+
+def extract_zip_to_tempdir(zip_path, buffer_size=EXTRACT_BUFFER_SIZE):
     with zipfile.ZipFile(zip_path, 'r') as zip_file:
-        temp_file = tempfile.SpooledTemporaryFile(max_size=2*1024*1024*1024) # 2GB max size
         temp_dir = tempfile.mkdtemp()
 
         # extract all files to temp directory
         for file_info in zip_file.infolist():
             file_path = os.path.join(temp_dir, file_info.filename)
-            with open(file_path, 'wb') as f:
-                f.write(zip_file.read(file_info.filename))
+            extract_zip_member(zip_file, file_info, file_path, buffer_size)
 
-        # seek to beginning of file to read its name
-        temp_file.seek(0)
-        return temp_file, temp_dir
+        return temp_dir
 
 
-def create_chd_from_zip(zip_path, chd_path, settings, special_info=None):
-    original_path = os.getcwd()
+def create_chd_from_zip(zip_path, chd_path, settings, special_info=None, build_info=None):
+    '''
+    extracts the zip into a temp directory and runs chdman createcd on its toc file
+    returns an error string if the chd couldn't be built, raises if chdman fails
+    if build_info is a dict it is updated with the chdman metrics and warnings
+    paths are handled relative to the temp directory rather than changing the working
+    directory so several builds can run at the same time
+    '''
+    chd_path = os.path.abspath(chd_path)
     with zipfile.ZipFile(zip_path, 'r') as zip_file:
         toc_file = None
         for file_info in zip_file.infolist():
@@ -83,20 +292,21 @@ def create_chd_from_zip(zip_path, chd_path, settings, special_info=None):
                 break
         if not toc_file:
             return 'No gdi, cue or iso file found in the zip archive'
+    buffer_size = settings.get('extract_buffer', EXTRACT_BUFFER_SIZE)
+    temp_dir = tempfile.mkdtemp(dir=settings['zip_temp'])
     try:
         with zipfile.ZipFile(zip_path, 'r') as zip_file:
-            temp_dir = tempfile.mkdtemp(dir=settings['zip_temp'])
-
             # extract all files to temp directory
-            for file_info in zip_file.infolist():
-                # handle manually zipped garbage added by osx
-                if not file_info.filename.startswith('__MACOSX/'):
-                    file_path = os.path.join(temp_dir, file_info.filename)
-                    with open(file_path, 'wb') as f:
-                        f.write(zip_file.read(file_info.filename))
-
-            os.chdir(temp_dir)
-            
+            input_bytes = 0
+            with stage('extract') as record:
+                for file_info in zip_file.infolist():
+                    # handle manually zipped garbage added by osx
+                    if not file_info.filename.startswith('__MACOSX/'):
+                        file_path = os.path.join(temp_dir, file_info.filename)
+                        extract_zip_member(zip_file, file_info, file_path, buffer_size)
+                        input_bytes += file_info.file_size
+                        record['items'] += 1
+
             # if the final argument is populated then take action
             if special_info:
                 # dat group will always be here
@@ -105,36 +315,473 @@ def create_chd_from_zip(zip_path, chd_path, settings, special_info=None):
                     while not manual_fix_check:
                         if toc_file.endswith('.cue'):
                             # no-intro non redump files use original cues but changed the actual filenames
-                            cue_file_list = parse_cue_sheet(toc_file)
+                            cue_file_list = parse_cue_sheet(os.path.join(temp_dir, toc_file))
                             # only handling renaming a single file at this time
                             if len(cue_file_list) == 1:
                                 for file in special_info['file_list']:
                                     if file.endswith('.gdi') or file.endswith('.cue'):
                                         continue
                                     else:
-                                        os.rename(file,cue_file_list[0])
+                                        os.rename(os.path.join(temp_dir, file),os.path.join(temp_dir, cue_file_list[0]))
                                 manual_fix_check = True
+                            elif not settings.get('interactive', True):
+                                return 'DAT & cue file contents don\'t match, a manual fix is needed'
                             else:
-                                print('DAT & cue file contents don\'t match')
-                                user_fix = inquirer.confirm('Do you want to manually fix the files?' , default=False)
-                                if user_fix:
-                                    print('Navigate to the temp directory configured for this script and ensure the filenames and cue contents match')
-                                    fixed = inquirer.confirm('Confirm Here when completed' , default=False)
-                                    if not fixed:
-                                        return 'no fix, continuing'
+                                # only one build at a time can ask for a manual fix
+                                with prompt_lock:
+                                    print('DAT & cue file contents don\'t match')
+                                    print('  Temp directory: '+temp_dir)
+                                    user_fix = inquirer.confirm('Do you want to manually fix the files?' , default=False)
+                                    if user_fix:
+                                        print('Navigate to the temp directory configured for this script and ensure the filenames and cue contents match')
+                                        fixed = inquirer.confirm('Confirm Here when completed' , default=False)
+                                        if not fixed:
+                                            return 'no fix, continuing'
+                                        else:
+                                            manual_fix_check = True
                                     else:
-                                        manual_fix_check = True
-                                else:
-                                    return 'no fix, continuing'
+                                        return 'no fix, continuing'
                         else:
                             manual_fix_check = True
 
             command = ['chdman', 'createcd', '-i', toc_file, '-o', chd_path]
-            subprocess.run(command, check=True, env=env_with_script_dir)
+            with stage('chdman', 1):
+                chdman_output = run_chdman(command, temp_dir, os.path.basename(chd_path))
+            if build_info is not None:
+                build_info.update(chdman_metrics(chdman_output, input_bytes, chd_path))
     finally:
-        os.chdir(original_path)
         shutil.rmtree(temp_dir)
 
+
+def run_chdman(command, cwd=None, label=None):
+    '''
+    runs chdman and parses its output as it is written, chdman rewrites its progress
+    line with carriage returns so output is split on both \\r and \\n
+    progress is printed prefixed with label, throttled so parallel builds stay readable
+    returns a dict with the last percent complete, compression ratio, elapsed seconds
+    and any warning lines.  raises CalledProcessError if chdman fails
+    '''
+    output = {'percent':None, 'ratio':None, 'elapsed':None, 'warnings':[]}
+    tail = []
+    start = time.monotonic()
+    progress = {'percent':0, 'time':start}
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            env=env_with_script_dir, cwd=cwd)
+    pending = b''
+    while True:
+        chunk = proc.stdout.read1(65536) if hasattr(proc.stdout, 'read1') else proc.stdout.read(65536)
+        if not chunk:
+            lines = [pending]
+        else:
+            lines = re.split(rb'[\r\n]', pending + chunk)
+            pending = lines.pop()
+        for raw_line in lines:
+            line = raw_line.decode('utf-8', errors='replace').strip()
+            if line:
+                parse_chdman_line(line, output)
+                tail = (tail + [line])[-CHDMAN_TAIL_LINES:]
+                if label and output['percent'] is not None:
+                    print_chdman_progress(label, output['percent'], progress)
+        if not chunk:
+            break
+    returncode = proc.wait()
+    output['elapsed'] = time.monotonic() - start
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, output='\n'.join(tail))
+    return output
+
+
+def print_chdman_progress(label, percent, progress):
+    '''
+    progress holds the last percent printed and when, prints go through prompt_lock so
+    lines from parallel builds don't interleave
+    '''
+    now = time.monotonic()
+    if percent - progress['percent'] < CHDMAN_PROGRESS_STEP and now - progress['time'] < CHDMAN_PROGRESS_SECONDS:
+        return
+    if percent == progress['percent']:
+        return
+    progress.update({'percent':percent, 'time':now})
+    with prompt_lock:
+        print(f'{label}: {percent:.1f}% complete')
+
+
+def parse_chdman_line(line, output):
+    percent = re.search(r'(\d+(?:\.\d+)?)% complete', line)
+    if percent:
+        output['percent'] = float(percent.group(1))
+    ratio = re.search(r'ratio\s*=\s*(\d+(?:\.\d+)?)%', line)
+    if ratio:
+        output['ratio'] = float(ratio.group(1))
+    if re.search(r'warning', line, re.IGNORECASE):
+        output['warnings'].append(line)
+
+
+def chdman_metrics(chdman_output, input_bytes, chd_path):
+    '''
+    converts parsed chdman output into per build metrics
+    '''
+    elapsed = chdman_output['elapsed'] or 0
+    try:
+        output_bytes = os.path.getsize(chd_path)
+    except OSError:
+        output_bytes = 0
+    ratio = chdman_output['ratio']
+    if ratio is None and input_bytes:
+        ratio = output_bytes / input_bytes * 100
+    return {'elapsed' : elapsed,
+            'input_bytes' : input_bytes,
+            'output_bytes' : output_bytes,
+            'mb_in_per_sec' : input_bytes / 2**20 / elapsed if elapsed else None,
+            'mb_out_per_sec' : output_bytes / 2**20 / elapsed if elapsed else None,
+            'ratio' : ratio,
+            'percent' : chdman_output['percent'],
+            'warnings' : chdman_output['warnings']}
+
+
+class DiskBudget:
+    '''
+    admission control for chd builds, a build is only started when both the temp and
+    destination filesystems have room for its extracted tracks and estimated chd.
+    free space is read from the filesystem while nothing is reserved on it, running
+    builds are already writing into their reservations so after that builds are admitted
+    against that free space less the reservations.  builds which don't fit wait until
+    another build releases space
+    '''
+    def __init__(self):
+        self.condition = threading.Condition()
+        # free space when nothing was reserved, reserved and peak reserved bytes per
+        # filesystem, keyed on st_dev
+        self.free = {}
+        self.reserved = {}
+        self.peak = {}
+        self.paths = {}
+
+    def space_needed(self, needs):
+        '''
+        needs is a path -> bytes dict, paths on the same filesystem are combined
+        '''
+        per_device = {}
+        devices = {path : os.stat(path).st_dev for path in needs}
+        with self.condition:
+            for path, size in needs.items():
+                self.paths.setdefault(devices[path], path)
+                per_device[devices[path]] = per_device.get(devices[path], 0) + size
+        return per_device
+
+    def fits(self, per_device):
+        for device, size in per_device.items():
+            if not self.reserved.get(device):
+                self.free[device] = shutil.disk_usage(self.paths[device]).free
+            if self.free[device] - self.reserved.get(device, 0) < size:
+                return False
+        return True
+
+    def acquire(self, needs):
+        '''
+        blocks until the space in needs can be reserved, returns the reservation
+        returns None if it can't fit even with nothing else reserved
+        '''
+        per_device = self.space_needed(needs)
+        with self.condition:
+            while not self.fits(per_device):
+                if not any(self.reserved.values()):
+                    return None
+                self.condition.wait()
+            for device, size in per_device.items():
+                self.reserved[device] = self.reserved.get(device, 0) + size
+                self.peak[device] = max(self.peak.get(device, 0), self.reserved[device])
+        return per_device
+
+    def release(self, per_device, kept=None):
+        '''
+        kept is a path -> bytes dict of output which stays on disk after the build, it's
+        taken off the free space until the filesystem is read again
+        '''
+        kept = self.space_needed(kept or {})
+        with self.condition:
+            for device, size in per_device.items():
+                self.reserved[device] -= size
+            for device, size in kept.items():
+                if device in self.free:
+                    self.free[device] -= size
+            self.condition.notify_all()
+
+    def print_peak(self):
+        for device, peak in self.peak.items():
+            print(f'  peak space reserved on {self.paths[device]}: {peak / 2**20:.1f} MB')
+
+
+def estimate_build_space(job, settings):
+    '''
+    returns the temp and destination bytes a build needs, the uncompressed track sizes
+    come from the zip directory and the chd size is estimated from them using
+    settings['chd_size_ratio']
+    '''
+    with zipfile.ZipFile(job['source_rom'], 'r') as zip_file:
+        extracted = sum(file_info.file_size for file_info in zip_file.infolist()
+                        if not file_info.filename.startswith('__MACOSX/'))
+    chd_size = int(extracted * settings.get('chd_size_ratio', CHD_SIZE_RATIO))
+    return {settings['zip_temp'] : extracted, os.path.dirname(job['chd_path']) : chd_size}
+
+
+def chd_store_dir(settings):
+    '''
+    the store defaults to a hidden directory in the chd directory so outputs can be
+    hardlinked into every platform directory
+    '''
+    return settings.get('chd_store', os.path.join(settings['chd'], '.store'))
+
+
+def chd_store_key(job, chdman_version=None):
+    '''
+    returns the store key for a job, a sha1 of the source member crcs and sizes and the
+    chdman version and parameters.  the zip path and member names aren't part of it so the
+    same disc matched from another dat or for another platform gets the same key, a new
+    chdman gets new keys so its chds are built rather than linked from older builds
+    '''
+    with zipfile.ZipFile(job['source_rom'], 'r') as zip_file:
+        members = sorted([f'{file_info.CRC:08x}', file_info.file_size] for file_info in zip_file.infolist()
+                         if not file_info.filename.startswith('__MACOSX/'))
+    special = job['special_info']['dat_group'] if job['special_info'] else None
+    params = {'version':CHD_STORE_VERSION, 'chdman':chdman_version, 'command':'createcd',
+              'special':special, 'members':members}
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def chd_store_path(settings, key):
+    return os.path.join(chd_store_dir(settings), key[:2], key+'.chd')
+
+
+def store_lock(key):
+    with store_locks_lock:
+        return store_locks.setdefault(key, threading.Lock())
+
+
+def reflink_file(src_path, dest_path):
+    '''
+    clones a whole file on filesystems with reflinks (btrfs/xfs), returns False if
+    the filesystem can't do it
+    '''
+    if not hasattr(fcntl, 'ioctl') or not sys.platform.startswith('linux'):
+        return False
+    with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+        try:
+            fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+        except OSError:
+            return False
+    return True
+
+
+def link_chd(src_path, dest_path):
+    '''
+    places src_path at dest_path as a hardlink, or a reflink or copy if they are on
+    different filesystems.  the link is made under a temp name and moved into place
+    so a partial copy is never left at dest_path
+    '''
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    temp_path = dest_path+'.tmp'
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    try:
+        os.link(src_path, temp_path)
+    except OSError:
+        if not reflink_file(src_path, temp_path):
+            shutil.copyfile(src_path, temp_path)
+    os.replace(temp_path, dest_path)
+
+
+def stored_chd(store_path):
+    '''
+    returns True if the store holds a readable chd at store_path, unreadable entries
+    are removed so they are rebuilt
+    '''
+    if not os.path.isfile(store_path):
+        return False
+    try:
+        read_chd_header(store_path)
+    except (ChdHeaderError, OSError):
+        os.remove(store_path)
+        return False
+    return True
+
+
+def build_chd_job(job, settings, budget=None, ledger=None, chdman_version=None):
+    '''
+    builds a single chd job, once the chd exists the other chd paths sharing the same
+    source are linked to it.  outputs are added to the chd store, a source which was
+    already built for any platform or in an earlier run is linked from the store
+    without running chdman
+    returns a result dict with the job and the error, error is None on success
+    '''
+    try:
+        key = chd_store_key(job, chdman_version)
+    except (OSError, zipfile.BadZipFile):
+        # the build reports what is wrong with the zip
+        key = None
+    if not key:
+        return create_job_chd(job, settings, budget, ledger)
+    store_path = chd_store_path(settings, key)
+    with store_lock(key):
+        if stored_chd(store_path):
+            result = link_stored_chd(job, store_path, ledger)
+        else:
+            result = create_job_chd(job, settings, budget, ledger)
+            if not result['error']:
+                try:
+                    link_chd(job['chd_path'], store_path)
+                except OSError as e:
+                    print('Unable to add '+os.path.basename(job['chd_path'])+' to the CHD store: '+str(e))
+    if result['error']:
+        return result
+    for link_path in job['links']:
+        try:
+            link_chd(job['chd_path'], link_path)
+        except OSError as e:
+            result['error'] = 'Unable to link '+link_path+': '+str(e)
+            return result
+        if ledger:
+            ledger.done({'chd_path':link_path}, result['source'], result['sha1'])
+    return result
+
+
+def link_stored_chd(job, store_path, ledger=None):
+    print('\nlinking '+os.path.basename(job['chd_path'])+' from the CHD store')
+    result = {'job':job, 'error':None, 'metrics':{}, 'stored':True, 'source':None, 'sha1':None}
+    try:
+        link_chd(store_path, job['chd_path'])
+        result['sha1'] = read_chd_header(job['chd_path'])['sha1']
+        if ledger:
+            result['source'] = source_fingerprint(job['source_rom'])
+            ledger.done(job, result['source'], result['sha1'])
+    except (ChdHeaderError, OSError, zipfile.BadZipFile) as e:
+        result['error'] = 'Unable to link from the CHD store: '+str(e)
+    return result
+
+
+def create_job_chd(job, settings, budget=None, ledger=None):
+    '''
+    runs chdman for a job, a failed build has any partial chd removed
+    if a DiskBudget is provided the build waits until there is space for it
+    if a BuildLedger is provided the build and the new chd sha1 are recorded in it
+    '''
+    reservation = None
+    if budget:
+        try:
+            reservation = budget.acquire(estimate_build_space(job, settings))
+        except Exception as e:
+            return {'job':job, 'error':'CHD Creation Failed: '+str(e), 'metrics':{}}
+        if not reservation:
+            return {'job':job, 'error':'Not enough free space in the temp or CHD directory', 'metrics':{}}
+    print('\nbuilding chd for '+job['description']+':')
+    print('            CHD: '+os.path.basename(job['chd_path']))
+    print('     Source Zip: '+os.path.basename(job['source_rom']))
+    build_info = {}
+    source = None
+    sha1 = None
+    error = None
+    try:
+        if ledger:
+            source = source_fingerprint(job['source_rom'])
+            ledger.started(job, source)
+        error = create_chd_from_zip(job['source_rom'],job['chd_path'],settings,job['special_info'],build_info)
+    except subprocess.CalledProcessError as e:
+        error = 'CHD Creation Failed: chdman exited with status '+str(e.returncode)
+        if e.output:
+            error += '\n'+e.output
+    except Exception as e:
+        error = 'CHD Creation Failed: '+str(e)
+    finally:
+        if reservation:
+            kept = {}
+            if not error and os.path.isfile(job['chd_path']):
+                kept[job['chd_path']] = os.path.getsize(job['chd_path'])
+            budget.release(reservation, kept)
+    if not error:
+        try:
+            sha1 = read_chd_header(job['chd_path'])['sha1']
+        except (ChdHeaderError, OSError) as e:
+            error = 'CHD Creation Failed: '+str(e)
+    if error and os.path.isfile(job['chd_path']):
+        # chdman can write most of a chd before failing, never leave it to be taken as built
+        try:
+            os.remove(job['chd_path'])
+        except:
+            error += '\nFailed to delete partial file, please ensure this is deleted to avoid corrupted files/hashes'
+    if ledger and source:
+        if error:
+            ledger.failed(job, source, error)
+        else:
+            ledger.done(job, source, sha1)
+    if not error:
+        if build_info.get('elapsed'):
+            print(f"built {os.path.basename(job['chd_path'])} in {build_info['elapsed']:.1f}s: "
+                  f"{build_info['mb_in_per_sec']:.1f} MB/s in, {build_info['mb_out_per_sec']:.1f} MB/s out, "
+                  f"ratio {build_info['ratio']:.1f}%")
+        for warning in build_info.get('warnings', []):
+            print('chdman warning for '+os.path.basename(job['chd_path'])+': '+warning)
+    return {'job':job, 'error':error, 'metrics':build_info, 'source':source, 'sha1':sha1}
+
+
+def run_chd_jobs(jobs, settings, workers=1, budget=None, ledger=None, chdman_version=None):
+    '''
+    runs chd build jobs with up to workers builds at the same time
+    each job is a dict with description, chd_path, source_rom, special_info and a list
+    of links, the other chd paths which share the same source zip
+    returns the result dicts in job order, failures are collected rather than stopping
+    '''
+    if jobs and not chdman_version:
+        chdman_version = chdman_info()
+    if workers <= 1:
+        return [build_chd_job(job, settings, budget, ledger, chdman_version) for job in jobs]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda job: build_chd_job(job, settings, budget, ledger, chdman_version), jobs))
+
+
+def flag_build(result, settings):
+    '''
+    returns the reasons a successful build should be reviewed, chdman warnings usually
+    mean a bad chd and very slow builds often point at a failing source disk
+    '''
+    reasons = []
+    metrics = result['metrics']
+    if metrics.get('warnings'):
+        reasons.append(f"{len(metrics['warnings'])} chdman warning(s)")
+    slow = settings.get('slow_build_mbps', SLOW_BUILD_MBPS)
+    # chdman start up dominates tiny builds so only larger ones are checked for speed
+    if (metrics.get('mb_in_per_sec') is not None and metrics['mb_in_per_sec'] < slow
+            and metrics['input_bytes'] >= SLOW_BUILD_MIN_BYTES):
+        reasons.append(f"slow build, {metrics['mb_in_per_sec']:.1f} MB/s")
+    return reasons
+
+
+def print_build_report(results, budget=None, settings=None):
+    if settings is None:
+        settings = {}
+    failures = [result for result in results if result['error']]
+    stored = [result for result in results if result.get('stored') and not result['error']]
+    print(f'\nbuilt {len(results) - len(failures) - len(stored)} of {len(results)} CHDs, '
+          f'{len(stored)} linked from the CHD store')
+    if budget:
+        budget.print_peak()
+    flagged = [(result, flag_build(result, settings)) for result in results if not result['error']]
+    flagged = [(result, reasons) for result, reasons in flagged if reasons]
+    if flagged:
+        print(f'{len(flagged)} CHD(s) should be reviewed:')
+        for result, reasons in flagged:
+            metrics = result['metrics']
+            print('  '+result['job']['description']+': '+os.path.basename(result['job']['chd_path']))
+            print('         Reason: '+', '.join(reasons))
+            for warning in metrics.get('warnings', []):
+                print('         chdman: '+warning)
+    if failures:
+        print(f'{len(failures)} CHD(s) failed:')
+        for result in failures:
+            print('  '+result['job']['description']+': '+os.path.basename(result['job']['chd_path']))
+            print('     Source Zip: '+os.path.basename(result['job']['source_rom']))
+            print('          Error: '+result['error'])
+
+
 def convert__bincue_to_chd(chd_file_path: pathlib.Path, output_cue_file_path: pathlib.Path, show_command_output: bool):
     # Use temporary directory for the chdman output files to keep those separate from the binmerge output files:
     with tempfile.TemporaryDirectory() as chdman_output_folder_path_name:
@@ -147,78 +794,154 @@ def convert__bincue_to_chd(chd_file_path: pathlib.Path, output_cue_file_path: pa
             raise ConversionException("Failed to convert .chd using chdman", chd_file_path, None)
 
 
-def find_rom_zips(dat,soft_entry_data,dathashdict,platform_settings):
-    zips = []
-    zip_matches = False
-    for disc, disc_info in soft_entry_data['parts'].items():
-        if 'source_sha' in disc_info and disc_info['source_sha'] in dathashdict:
-            dat_game_entry = dathashdict[disc_info['source_sha']]
-            try:
-                # check the entry from the dat against the directory the DAT points to
-                goodzip = check_valid_zips(dat_game_entry,platform_settings[dat])
-            except:
-                print('key error for '+disc+', dat: '+dat)
-                continue
-            if goodzip:
-                dat_game_entry.update({'source_rom':goodzip})
-                disc_info.update({'source_rom':goodzip})
-                zips.append(os.path.basename(goodzip))
-                zip_matches = True
-            else:
-                zips.append('No Valid Zip')
-    if zip_matches:
-        return zips
-    else:
+def find_part_zip(dat,disc,dat_game_entry,platform_settings):
+    '''
+    checks the entry from the dat against the ROM directory the DAT points to
+    returns the zip path if a valid zip exists, otherwise None
+    '''
+    try:
+        return check_valid_zips(dat_game_entry,platform_settings[dat])
+    except:
+        print('key error for '+disc+', dat: '+dat)
         return None
 
 
-def find_softlist_zips(soft_list, platform_dats,dat_rom_map):
-    '''
-    iterates through the soft_list to check source DAT and fingerprint
-    checks the platform_dats for the description to calculate the name
-    gets the ROM folder from the dat_rom_map to find a matching ZIP
-    Checks the ZIP contents, returns the list of valid matches
-    deprecated in favor of doing the check rom by rom from another function
-    '''
-    print('checking all source zip files')
-    valid_zips = {}
-    for soft, softdata in soft_list.items():
-        if 'sourcedat' in softdata:
-            dat = softdata['sourcedat']
-            for disc, disc_info in softdata['parts'].items():
-                if 'source_sha' in disc_info and disc_info['source_sha'] in platform_dats[dat]:
-                    game_entry = platform_dats[dat][disc_info['source_sha']]
-                    goodzip = check_valid_zips(game_entry,dat_rom_map[dat])
-                    if goodzip:
-                        disc_info.update({'source_rom':goodzip})
-                        valid_zips.update({sha:goodzip})
-        else:
-            continue
-    print('found '+str(len(valid_zips))+' valid rom sources which can be coverted to CHD')
+def verify_source_zips(zip_checks,platform_settings,workers_per_root=4,executor=None,root_limits=None):
+    '''
+    validates the zips for a list of (dat, disc, dat_game_entry) checks using a bounded
+    thread pool, at most workers_per_root zips are open at once in each ROM folder
+    an executor and root_limits dict can be passed in to share the pool and the per
+    folder limits between platforms which are mapped at the same time
+    returns the valid zip path or None for each check, in the same order as zip_checks
+    '''
+    if not zip_checks:
+        return []
+    if root_limits is None:
+        root_limits = {}
+    for dat, disc, dat_game_entry in zip_checks:
+        rom_folder = platform_settings.get(dat)
+        if rom_folder not in root_limits:
+            root_limits.setdefault(rom_folder, threading.BoundedSemaphore(workers_per_root))
+
+    def check_zip(zip_check):
+        dat, disc, dat_game_entry = zip_check
+        with root_limits[platform_settings.get(dat)]:
+            return find_part_zip(dat,disc,dat_game_entry,platform_settings)
+
+    with stage('zip_verify', len(zip_checks)):
+        if executor:
+            return list(executor.map(check_zip, zip_checks))
+        with ThreadPoolExecutor(max_workers=workers_per_root*len(root_limits)) as executor:
+            return list(executor.map(check_zip, zip_checks))
+
+
+def load_zip_cache():
+    '''
+    restores the zip validation cache saved by an earlier run and resets the counters
+    '''
+    zip_cache.clear()
+    zip_cache_used.clear()
+    for counter in zip_cache_stats:
+        zip_cache_stats[counter] = 0
+    try:
+        with open(zip_cache_path, 'rb') as f:
+            saved = pickle.load(f)
+    except:
+        return
+    if saved.get('version') == ZIP_CACHE_VERSION:
+        zip_cache.update(saved['zips'])
+
+
+def save_zip_cache():
+    '''
+    saves the zip cache.  in rom folders checked this run, entries for zips which weren't
+    checked are dropped as the zip was deleted, renamed or left the dats.  entries in
+    other folders are kept unless the folder is gone
+    '''
+    with zip_cache_lock:
+        checked_dirs = {os.path.dirname(zip_path) for zip_path in zip_cache_used}
+        dir_exists = {}
+        for zip_path in list(zip_cache):
+            directory = os.path.dirname(zip_path)
+            if directory in checked_dirs:
+                stale = zip_path not in zip_cache_used
+            else:
+                if directory not in dir_exists:
+                    dir_exists[directory] = os.path.isdir(directory)
+                stale = not dir_exists[directory]
+            if stale:
+                zip_cache.pop(zip_path)
+        entry = {'version':ZIP_CACHE_VERSION, 'zips':dict(zip_cache)}
+    try:
+        write_cache_entry(zip_cache_path, entry)
+    except (OSError, pickle.PicklingError) as e:
+        print('unable to save the zip cache: '+str(e))
+
+
+def dat_entry_fingerprint(dat_entry):
+    '''
+    sha1 of the dat entry's file names and crcs, a zip verdict is only valid for the
+    dat entry it was checked against
+    '''
+    file_list = sorted(dat_entry['file_list'].items())
+    return hashlib.sha1(repr(file_list).encode('utf-8')).hexdigest()
+
+
+def zip_members_match(members,dat_entry):
+    '''
+    compares a zip's member crc table against the files listed for a dat entry
+    '''
+    for filename, crc in dat_entry['file_list'].items():
+        if members.get(filename) != int(crc, 16):
+            return False
+    return True
 
 
 def check_valid_zips(dat_entry,rom_folder):
     '''
     Checks the ZIP contents to ensure it's a valid dat match, returns valid matches
+    zips are only opened if they aren't in the zip cache or have changed size/mtime
     TODO - add 7zip support
     '''
     name_with_zip = dat_entry['name'] + '.zip'
     #print('checking '+name_with_zip+' in folder '+rom_folder)
     zip_path = os.path.join(rom_folder, name_with_zip)
-    if os.path.isfile(zip_path):
+    # existence and size/mtime come from the rom folder listing rather than a probe per zip
+    zip_stat = indexed_stat(zip_path)
+    with zip_cache_lock:
+        zip_cache_used.add(zip_path)
+    if not zip_stat:
+        with zip_cache_lock:
+            if zip_path in zip_cache:
+                zip_cache.pop(zip_path)
+                zip_cache_stats['invalidations'] += 1
+        return None
+    fingerprint = dat_entry_fingerprint(dat_entry)
+    with zip_cache_lock:
+        cached = zip_cache.get(zip_path)
+        if cached and cached['size'] == zip_stat.st_size and cached['mtime_ns'] == zip_stat.st_mtime_ns:
+            zip_cache_stats['hits'] += 1
+            if fingerprint not in cached['verdicts']:
+                cached['verdicts'][fingerprint] = zip_members_match(cached['members'],dat_entry)
+            matches = cached['verdicts'][fingerprint]
+        else:
+            if cached:
+                zip_cache_stats['invalidations'] += 1
+            zip_cache_stats['misses'] += 1
+            cached = None
+    if not cached:
+        # the zip is opened outside the lock so other checks can run at the same time
         with zipfile.ZipFile(zip_path, 'r') as zip_file:
-            matches = True
-            for filename, crc in dat_entry['file_list'].items():
-                if not matches:
-                    break
-                if filename not in zip_file.namelist():
-                    matches = False
-                    break
-                zip_info = zip_file.getinfo(filename)
-                if zip_info.CRC != int(crc, 16):
-                    matches = False
-                    break
-            if matches:
-                return zip_path
-            else:
-                return None
+            members = {zip_info.filename : zip_info.CRC for zip_info in zip_file.infolist()}
+        matches = zip_members_match(members,dat_entry)
+        with zip_cache_lock:
+            zip_cache[zip_path] = {
+                'size' : zip_stat.st_size,
+                'mtime_ns' : zip_stat.st_mtime_ns,
+                'members' : members,
+                'verdicts' : {fingerprint : matches}
+            }
+    if matches:
+        return zip_path
+    else:
+        return None
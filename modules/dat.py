@@ -1,12 +1,30 @@
-import re, xmltodict, hashlib
+import re, os, mmap, shutil, pickle, xmltodict, hashlib
 import xml.etree.ElementTree as ET
 import html
+from xml.sax.saxutils import escape
+from concurrent.futures import ProcessPoolExecutor
 from  lxml import etree
+from modules.cache import file_signature, load_file_cache, store_file_cache
+from modules.utils import convert_xml
+from modules.profiling import stage
 
 
 '''
 Softlist processing functions
 '''
+# on-disk softlist cache format, bump whenever build_sl_dict or the comment parsing
+# functions change what ends up in the softlist dict
+SL_CACHE_VERSION = 1
+
+# tokens the in-place sha1 patcher tracks, comments and cdata are matched so anything
+# inside them is skipped
+softlist_token_regex = re.compile(rb'<!--.*?-->|<!\[CDATA\[.*?\]\]>|</software\s*>|<(software|part|disk)(\s[^>]*)?>', re.S)
+name_attr_regex = re.compile(rb'\sname\s*=\s*(["\'])(.*?)\1', re.S)
+sha1_attr_regex = re.compile(rb'\ssha1\s*=\s*(["\'])(.*?)\1', re.S)
+
+# everything restore_lxml_formatting may need to change in lxml output, self closed
+# tags and text nodes containing a quote
+lxml_token_regex = re.compile(r'<[^<>]*/>|(?<=>)[^<>]*"[^<>]*(?=<)')
 
 def get_source_stats(sl_platform_dict):
     '''
@@ -160,14 +178,15 @@ def rom_entries_to_source_ids(soft_title,raw_rom_source_data):
     return concatenated_hashes, source_type, sizes
 
 
-def process_sl_rom_sources(softdict):
+def process_sl_rom_sources(softdict, quiet=False):
     '''
     iterates through the rom entires in a Software List dict to build fingerprint hashes.
     cue and gdi files are ignored for hashes and size calculations as they can change over
     time.  multiple discs are listed serially in the same object, so cue/gdi are used as
     separators
     '''
-    print('Building Source fingerprints from software list')
+    if not quiet:
+        print('Building Source fingerprints from software list')
     for soft_title, soft_data in softdict.items():
         if 'rom' in soft_data:
             concatenated_hashes, source_type, sizes = rom_entries_to_source_ids(soft_title,soft_data['rom'])
@@ -252,7 +271,7 @@ def process_comments(soft, sl_dict):
     else:
         comment_to_sl_dict(soft,raw_comment_dict,sl_dict)
         
-def build_sl_dict(softlist, sl_dict):
+def build_sl_dict(softlist, sl_dict, quiet=False):
     '''
     grabs useful sofltist data and inserts into a simpler dict object
     '''
@@ -286,7 +305,25 @@ def build_sl_dict(softlist, sl_dict):
         # converts comments to dict
         process_comments(soft, sl_dict)
     # build source hashes based on parsed comments
-    process_sl_rom_sources(sl_dict)
+    process_sl_rom_sources(sl_dict, quiet)
+
+def load_sl_dict(softlist_xml_file, quiet=False):
+    '''
+    returns the finished softlist dict for a hash xml file, the comment parsing and
+    source fingerprinting is skipped when the xml hasn't changed since the last run
+    '''
+    cached = load_file_cache('softlists', softlist_xml_file, SL_CACHE_VERSION)
+    if cached is not None:
+        return cached
+    signature = file_signature(softlist_xml_file)
+    with stage('softlist_load'):
+        raw_sl_dict = convert_xml(softlist_xml_file, comments=True)
+    sl_dict = {}
+    with stage('comment_fingerprint') as record:
+        build_sl_dict(raw_sl_dict['softwarelist']['software'], sl_dict, quiet)
+        record['items'] = len(sl_dict)
+    save_file_cache('softlists', softlist_xml_file, SL_CACHE_VERSION, sl_dict, signature)
+    return sl_dict
 
 def print_sha1s(softlist):
     for item in my_soft['software']:
@@ -328,13 +365,125 @@ def get_lxml_replacements(softlist_xml_file):
     for match in entity_list.finditer(xml_string):
         # get the matched tag as a string
         entity_str = match.group(0)
-        # unescape the entities to create the new key
-        new_key = html.unescape(entity_str)
+        # the key is the text as lxml writes it, quotes unescaped but &, < and > escaped
+        new_key = '>'+escape(html.unescape(entity_str[1:-1]))+'<'
         # add the new key and the matched tag as the value to the dictionary
         lxml_changes[new_key] = entity_str
     return lxml_changes
 
+def restore_lxml_formatting(output, lxml_changes):
+    '''
+    puts back the changes found by get_lxml_replacements in a single pass over the lxml
+    output.  each self closed tag and each quoted text node is looked up in the changes
+    dict rather than searching the whole output once per change
+    '''
+    def restore(match):
+        token = match.group(0)
+        if token[0] == '<':
+            return lxml_changes.get(token, token)
+        # text node changes are keyed with the surrounding > and <
+        restored = lxml_changes.get('>'+token+'<')
+        return restored[1:-1] if restored else token
+    return lxml_token_regex.sub(restore, output)
+
+def write_softlist_tree(tree, softlist_xml_file, lxml_changes=None):
+    '''
+    serializes a softlist parsed with lxml, restoring the original formatting if
+    lxml_changes is given.  it must be read with get_lxml_replacements before the file
+    is overwritten
+    '''
+    output = etree.tostring(
+        tree,
+        pretty_print=True,
+        xml_declaration=True,
+        encoding="UTF-8",
+        doctype='<!DOCTYPE softwarelist SYSTEM "softwarelist.dtd">'
+    ).decode("UTF-8")
+    with stage('softlist_write'):
+        if lxml_changes:
+            output = restore_lxml_formatting(output, lxml_changes)
+        with open(softlist_xml_file, "w",encoding='utf-8') as f:
+            f.write(output)
+
+def get_softlist_sha1_edits(soft_dict):
+    '''
+    returns a software name -> {part name: new sha1} dict of the chd hashes to write
+    '''
+    edits = {}
+    for soft, soft_data in soft_dict.items():
+        parts = {part:part_data['new_sha1'] for part, part_data in soft_data['parts'].items() if 'new_sha1' in part_data}
+        if parts:
+            edits[soft] = parts
+    return edits
+
+def find_softlist_sha1_spans(softlist_data, edits):
+    '''
+    scans the softlist once tracking the current software and part, returns the
+    (start, end, new sha1) byte spans of each sha1 attribute value to rewrite and the
+    (software, part) edits that were found.  only the first disk in a part is patched
+    '''
+    spans = []
+    found = set()
+    soft_parts = None
+    part_key = None
+    for match in softlist_token_regex.finditer(softlist_data):
+        tag = match.group(1)
+        if not tag:
+            if match.group(0).startswith(b'</software'):
+                soft_parts = None
+            continue
+        attrs = match.group(2) or b''
+        name = name_attr_regex.search(attrs)
+        name = html.unescape(name.group(2).decode('utf-8')) if name else None
+        if tag == b'software':
+            soft_name = name
+            soft_parts = edits.get(name)
+            part_key = None
+        elif tag == b'part' and soft_parts:
+            # single disk entries are renamed cdrom1 for source matching
+            if name not in soft_parts and name == 'cdrom' and 'cdrom1' in soft_parts:
+                name = 'cdrom1'
+            part_key = name if name in soft_parts else None
+        elif tag == b'disk' and soft_parts and part_key:
+            sha1 = sha1_attr_regex.search(attrs)
+            if sha1:
+                offset = match.start(2) + sha1.start(2)
+                spans.append((offset, offset + len(sha1.group(2)), soft_parts[part_key].encode('ascii')))
+                found.add((soft_name, part_key))
+            part_key = None
+    return spans, found
+
 def update_softlist_chd_sha1s(softlist_xml_file, soft_dict):
+    '''
+    writes new chd sha1s to the softlist by rewriting only the sha1 attribute values in
+    place, everything else in the file is left byte for byte as it was.  the result is
+    written to a temp file and moved over the softlist.  if a disk to update can't be
+    found, e.g. it has no sha1 attribute yet, the lxml writer is used instead
+    '''
+    edits = get_softlist_sha1_edits(soft_dict)
+    if not edits:
+        return
+    with stage('softlist_write') as record:
+        with open(softlist_xml_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as softlist_data:
+            spans, found = find_softlist_sha1_spans(softlist_data, edits)
+            in_place = len(found) == sum(len(parts) for parts in edits.values())
+            if in_place:
+                temp_path = softlist_xml_file+'.tmp'
+                with open(temp_path, 'wb') as out:
+                    position = 0
+                    for start, end, sha1 in spans:
+                        out.write(softlist_data[position:start])
+                        out.write(sha1)
+                        position = end
+                    out.write(softlist_data[position:])
+        if in_place:
+            shutil.copymode(softlist_xml_file, temp_path)
+            os.replace(temp_path, softlist_xml_file)
+            record['items'] = len(spans)
+    if not in_place:
+        update_softlist_chd_sha1s_lxml(softlist_xml_file, soft_dict)
+
+def update_softlist_chd_sha1s_lxml(softlist_xml_file, soft_dict):
     # build a dictionary for whitespace in tags that lxml will delete
     tags_with_whitespace = get_lxml_replacements(softlist_xml_file)
     # Parse the XML file using lxml
@@ -365,18 +514,7 @@ def update_softlist_chd_sha1s(softlist_xml_file, soft_dict):
         else:
             continue
     # Write the updated XML to disk while preserving the original comments
-    output = etree.tostring(
-        tree,
-        pretty_print=True,
-        xml_declaration=True,
-        encoding="UTF-8",
-        doctype='<!DOCTYPE softwarelist SYSTEM "softwarelist.dtd">'
-    ).decode("UTF-8")
-    # put back the whitespace lxml deleted
-    for old_string, new_string in tags_with_whitespace.items():
-        output = output.replace(old_string, new_string)
-    with open(softlist_xml_file, "w",encoding='utf-8') as f:
-        f.write(output)
+    write_softlist_tree(tree, softlist_xml_file, tags_with_whitespace)
 
 
 def get_sl_entry(search_list, title, type):
@@ -418,16 +556,7 @@ def update_sl_descriptions(softlist_xml_file, answerdict):
                 continue
 
     # Write the updated XML to disk while preserving the original comments
-    output = etree.tostring(
-        tree,
-        pretty_print=True,
-        xml_declaration=True,
-        encoding="UTF-8",
-        doctype='<!DOCTYPE softwarelist SYSTEM "softwarelist.dtd">'
-    ).decode("UTF-8")
-
-    with open(softlist_xml_file, "w",encoding='utf-8') as f:
-        f.write(output)
+    write_softlist_tree(tree, softlist_xml_file)
 
 def add_redump_names_to_slist(softlist_xml_file, answerdict,redump_name_list):
     '''
@@ -459,16 +588,7 @@ def add_redump_names_to_slist(softlist_xml_file, answerdict,redump_name_list):
                 software.insert(part_index, new_tag)
 
     # Write the updated XML to disk while preserving the original comments
-    output = etree.tostring(
-        tree,
-        pretty_print=True,
-        xml_declaration=True,
-        encoding="UTF-8",
-        doctype='<!DOCTYPE softwarelist SYSTEM "softwarelist.dtd">'
-    ).decode("UTF-8")
-
-    with open(softlist_xml_file, "w",encoding='utf-8') as f:
-        f.write(output)
+    write_softlist_tree(tree, softlist_xml_file)
 
 
 
@@ -476,11 +596,16 @@ def add_redump_names_to_slist(softlist_xml_file, answerdict,redump_name_list):
 '''
 dat processing functions
 '''
-def build_dat_dict(datfile,raw_dat_dict,dat_dict):
+# header fields keyed on (path, mtime, size), filled by read_dat_header
+dat_header_cache = {}
+
+# on-disk fingerprint cache format, bump whenever the output of parse_dat_hashes or
+# add_dat_game_fingerprints changes so older cache entries are rebuilt
+DAT_CACHE_VERSION = 1
+
+def init_dat_dict(dat_dict):
     '''
-    grabs data from dat structure puts it into a new dict
-    raw_dat_dict is the raw dat source xml converted to a dict
-    dat_dict is the dict object which will store all the lookup tables with dat info for this platform
+    adds the lookup tables used for a platform's dats if they don't exist yet
     '''
     if 'dat_group' not in dat_dict:
         dat_dict.update({'dat_group':{}})
@@ -490,40 +615,203 @@ def build_dat_dict(datfile,raw_dat_dict,dat_dict):
         dat_dict.update({'hashes':{}})
     if 'duplicates' not in dat_dict:
         dat_dict.update({'duplicates':{}})
+
+def add_dat_fingerprints(datfile,fingerprints,dat_dict):
+    keyresult, nameresult, dat_group = fingerprints
+    dat_dict['hashes'].update({datfile : keyresult})
+    dat_dict['redump_unmatched'].update({datfile : nameresult})
+    dat_dict['dat_group'].update({datfile : dat_group})
+
+def build_dat_dict(datfile,dat_dict):
+    '''
+    streams the dat file and puts the fingerprint lookup tables into a new dict
+    dat_dict is the dict object which will store all the lookup tables with dat info for this platform
+    '''
+    init_dat_dict(dat_dict)
     try:
-        keyresult, nameresult = create_dat_hash_dict(raw_dat_dict)
-        dat_dict['hashes'].update({datfile : keyresult})
-        dat_dict['redump_unmatched'].update({datfile : nameresult})
-        dat_dict['dat_group'].update({datfile : get_dat_group(datfile)})
+        add_dat_fingerprints(datfile,load_dat_fingerprints(datfile),dat_dict)
     except:
         print('unexpected error processing '+datfile)
 
 
-def remove_dupe_dat_entries(platform_dat_dict):
-    # dedupe entries in other dats that exist in redump
-    dupe_count = 0
-    for lookup_dat, lookup_hash_dict in platform_dat_dict['hashes'].items():
-        pop_list = []
-        # get current dat group
-        dat_group = platform_dat_dict['dat_group'][lookup_dat]
-        # skip redump 
-        if dat_group == 'redump':
+def build_platform_dat_dict(datfiles,dat_dict,workers=None):
+    '''
+    fingerprints all the dats for a platform, dats which aren't in the fingerprint cache
+    are parsed in a process pool.  results are merged in the order of datfiles so
+    duplicate handling in remove_dupe_dat_entries is the same as a serial run
+    workers defaults to the number of cpus
+    '''
+    init_dat_dict(dat_dict)
+    results = load_dat_results(datfiles,workers)
+    for datfile in datfiles:
+        if datfile in results:
+            add_dat_fingerprints(datfile,results[datfile],dat_dict)
+        else:
+            print('unexpected error processing '+datfile)
+
+
+def load_dat_results(datfiles,workers=None):
+    '''
+    returns a datfile -> fingerprints dict, cached dats are loaded from the fingerprint
+    cache and the rest are parsed by parse_dats.  dats which can't be parsed are left out
+    '''
+    results = {}
+    uncached = []
+    with stage('dat_load', len(datfiles)):
+        for datfile in datfiles:
+            try:
+                cached = load_file_cache('dats', datfile, DAT_CACHE_VERSION)
+            except:
+                cached = None
+            if cached is not None:
+                results[datfile] = cached
+            else:
+                uncached.append(datfile)
+        results.update(parse_dats(uncached,workers))
+    return results
+
+
+def cache_dat_fingerprints(datfiles,workers=None):
+    '''
+    makes sure every dat is in the fingerprint cache, parsing the missing ones.  when
+    several platforms are mapped together each dat is parsed once here and each platform
+    then loads its own copy from the cache, so only the platforms being mapped hold dat
+    fingerprints in memory
+    '''
+    uncached = []
+    datfiles = list(dict.fromkeys(datfiles))
+    with stage('dat_load', len(datfiles)):
+        for datfile in datfiles:
+            try:
+                cached = load_file_cache('dats', datfile, DAT_CACHE_VERSION)
+            except:
+                cached = None
+            if cached is None:
+                uncached.append(datfile)
+        parse_dats(uncached,workers)
+
+
+def parse_dats(datfiles,workers=None):
+    '''
+    parses dats in a process pool and adds them to the fingerprint cache
+    returns a datfile -> fingerprints dict of the dats which could be parsed
+    workers defaults to the number of cpus
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(datfiles))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {datfile : executor.submit(parse_dat_fingerprints, datfile) for datfile in datfiles}
+            parsed = {}
+            for datfile, future in futures.items():
+                try:
+                    parsed[datfile] = future.result()
+                except:
+                    parsed[datfile] = None
+    else:
+        parsed = {}
+        for datfile in datfiles:
+            try:
+                parsed[datfile] = parse_dat_fingerprints(datfile)
+            except:
+                parsed[datfile] = None
+    results = {}
+    for datfile, result in parsed.items():
+        if result is None:
             continue
-        # look for each source ID for this dat across all the DATs
-        for source_id in lookup_hash_dict:
-            for dat, hash_dict in platform_dat_dict['hashes'].items():
-                # skip cases where the source and dest is same group
-                if dat_group == platform_dat_dict['dat_group'][dat]:
-                    continue
-                if source_id in hash_dict:
-                    pop_list.append(source_id)
+        signature, fingerprints = result
+        save_file_cache('dats', datfile, DAT_CACHE_VERSION, fingerprints, signature)
+        results[datfile] = fingerprints
+    return results
+
+
+def parse_dat_fingerprints(datfile):
+    '''
+    parses a dat without touching the cache so it can run in a worker process
+    returns the file signature taken before parsing along with the fingerprints
+    '''
+    signature = file_signature(datfile)
+    keyresult, nameresult = parse_dat_hashes(datfile)
+    return signature, (keyresult, nameresult, get_dat_group(datfile))
+
+
+def load_dat_fingerprints(datfile):
+    '''
+    returns the hash lookup, name lookup and dat group for a dat file, reusing the
+    on-disk fingerprint cache when the dat hasn't changed since it was last parsed
+    '''
+    cached = load_file_cache('dats', datfile, DAT_CACHE_VERSION)
+    if cached is not None:
+        return cached
+    signature, fingerprints = parse_dat_fingerprints(datfile)
+    save_file_cache('dats', datfile, DAT_CACHE_VERSION, fingerprints, signature)
+    return fingerprints
+
+
+def save_file_cache(kind, source_path, version, data, signature):
+    '''
+    stores a parse result in the file cache, the parse already succeeded so a cache that
+    can't be written is reported and the result used anyway
+    '''
+    try:
+        store_file_cache(kind, source_path, version, data, signature)
+    except (OSError, pickle.PicklingError) as e:
+        print('unable to cache '+os.path.basename(source_path)+': '+str(e))
+
+
+def build_source_index(platform_dat_dict):
+    '''
+    builds a source_id -> [dat files] inverted index across all the dats for a platform
+    the dats for each source_id are listed in platform_dat_dict['hashes'] order
+    '''
+    source_index = {}
+    for datfile, hash_dict in platform_dat_dict['hashes'].items():
+        for source_id in hash_dict:
+            if source_id in source_index:
+                source_index[source_id].append(datfile)
+            else:
+                source_index[source_id] = [datfile]
+    platform_dat_dict['source_index'] = source_index
+    return source_index
+
+
+def get_source_dats(platform_dat_dict, source_id):
+    '''
+    returns the list of dats which contain the source_id fingerprint
+    '''
+    return platform_dat_dict['source_index'].get(source_id, [])
+
+
+def remove_dupe_dat_entries(platform_dat_dict, quiet=False):
+    '''
+    dedupe entries in other dats that exist in redump, or in any other dat group.  a
+    source id is dropped from a non-redump dat if a dat from a different group still
+    holds it, dats are processed in order so the result matches the earlier pairwise
+    comparison.  the source index is kept up to date for later lookups
+    returns the number of entries removed
+    '''
+    dupe_count = 0
+    dat_groups = platform_dat_dict['dat_group']
+    with stage('dedup') as record:
+        source_index = build_source_index(platform_dat_dict)
+        record['items'] = len(source_index)
+        for lookup_dat, lookup_hash_dict in platform_dat_dict['hashes'].items():
+            # get current dat group
+            dat_group = dat_groups[lookup_dat]
+            # skip redump
+            if dat_group == 'redump':
+                continue
+            for source_id in list(lookup_hash_dict):
+                source_dats = source_index[source_id]
+                if any(dat_groups[dat] != dat_group for dat in source_dats):
+                    lookup_hash_dict.pop(source_id)
+                    source_dats.remove(lookup_dat)
+                    dupe_count += 1
+    if not quiet:
+        print(f'removed {dupe_count} duplicate DAT entries')
+    return dupe_count
 
-        for to_delete in pop_list:
-            if to_delete in lookup_hash_dict:
-                lookup_hash_dict.pop(to_delete)
-                dupe_count += 1
-    print(f'removed {dupe_count} duplicate DAT entries')
-                
 
 
 
@@ -549,57 +837,83 @@ def build_dat_dict_xml(datfile,dat_dict):
 
 
 
+def add_dat_game_fingerprints(name,roms,keyresult,nameresult):
+    '''
+    roms is a list of (filename, size, crc, sha1) tuples for a single dat game entry
+    builds lookup keys based on concatenating rom sha1s and creating a new sha1
+    same is done for crc for old rom sources which don't use sha1
+    cue and gdi files are skipped to match the softlist fingerprints
+    '''
+    file_list = {}
+    files = len(roms)
+    size = 0
+    sha1 = hashlib.sha1()
+    crc_sha1 = hashlib.sha1()
+    for rom_name, rom_size, rom_crc, rom_sha1 in roms:
+        file_list.update({rom_name:rom_crc})
+        if not rom_name.lower().endswith(('.cue', '.gdi')):
+            sha1.update(rom_sha1.encode('utf-8'))
+            crc_sha1.update(rom_crc.encode('utf-8'))
+            size = size + int(rom_size)
+    sha1_digest = sha1.hexdigest()
+    crc_sha1_digest = crc_sha1.hexdigest()
+    if (sha1_digest,'sha1') in keyresult:
+        print('duplicate dat entry for '+name)
+        print('overwriting '+keyresult[(sha1_digest,'sha1')]['name'])
+    # will add filecount later not calculated in the softlist processing yet
+    #keyresult[(sha1_digest,'sha1',files)] = {
+    keyresult[(sha1_digest,'sha1')] = {
+        'name': name,
+        'files': files,
+        'size': size,
+        'file_list': file_list
+    }
+    # repeat for crc for old rom sources
+    keyresult[(crc_sha1_digest,'crc')] = {
+        'name': name,
+        'files': files,
+        'size': size,
+        'file_list': file_list
+    }
+    # enables name to hash lookups based on softlist descriptions/redump serials
+    nameresult[name] = {
+        'sha1_digest' : sha1_digest
+    }
+
+
+def parse_dat_hashes(datfile):
+    '''
+    streaming replacement for convert_xml + create_dat_hash_dict, each game element is
+    fingerprinted as soon as it has been parsed and then cleared so memory use doesn't
+    grow with the size of the dat
+    returns the same hash and name lookup tables as create_dat_hash_dict
+    '''
+    keyresult = {}
+    nameresult = {}
+    for event, game in etree.iterparse(datfile, events=('end',), tag='game'):
+        roms = [(rom.get('name'), rom.get('size'), rom.get('crc'), rom.get('sha1'))
+                for rom in game.iterfind('rom')]
+        if roms:
+            add_dat_game_fingerprints(game.get('name'),roms,keyresult,nameresult)
+        # free the parsed game and any earlier siblings still referenced by the root
+        game.clear()
+        while game.getprevious() is not None:
+            del game.getparent()[0]
+    return keyresult, nameresult
+
+
 def create_dat_hash_dict(raw_dat_dict):
     '''
     takes the raw dat xml converted to a dict and parses each entry to build 
     lookup keys based on concatenating rom sha1s and creating a new sha1
     same is done for crc for old rom sources which don't use sha1
+    superseded by parse_dat_hashes which doesn't need the whole dat in memory
     '''
     keyresult = {}
     nameresult = {}
     for game in raw_dat_dict['game']:
-        file_list = {}
-        name = game['@name']
-        files = len(game['rom'])
-        size = 0
-        sha1 = hashlib.sha1()
-        for rom in game['rom']:
-            file_list.update({rom['@name']:rom['@crc']})
-            if not rom['@name'].lower().endswith(('.cue', '.gdi')):
-                sha1.update(rom['@sha1'].encode('utf-8'))
-                size = size + int(rom['@size'])
-        sha1_digest = sha1.hexdigest()
-        if sha1_digest in keyresult:
-            print('duplicate dat entry for '+name)
-        # will add filecount later not calculated in the softlist processing yet
-        #keyresult[(sha1_digest,'sha1',files)] = {
-        keyresult[(sha1_digest,'sha1')] = {
-            'name': name,
-            'files': files,
-            'size': size,
-            'file_list': file_list
-        }
-        # repeat for crc for old rom sources
-        crc_sha1 = hashlib.sha1()
-        for rom in game['rom']:
-            if not rom['@name'].lower().endswith(('.cue', '.gdi')):
-                crc_sha1.update(rom['@crc'].encode('utf-8'))
-        crc_sha1_digest = crc_sha1.hexdigest()
-        if crc_sha1_digest in keyresult:
-            print('duplicate dat entry for '+name)
-            print('overwriting '+keyresult[crc_sha1_digest]['name'])
-        # will add filecount later not calculated in the softlist processing yet
-        #keyresult[(crc_sha1_digest,'crc',files)] = {
-        keyresult[(crc_sha1_digest,'crc')] = {
-            'name': name,
-            'files': files,
-            'size': size,
-            'file_list': file_list
-        }
-        # enables name to hash lookups based on softlist descriptions/redump serials
-        nameresult[name] = {
-            'sha1_digest' : sha1_digest
-        }
+        roms = [(rom['@name'], rom['@size'], rom['@crc'], rom['@sha1']) for rom in game['rom']]
+        add_dat_game_fingerprints(game['@name'],roms,keyresult,nameresult)
     return keyresult, nameresult
 
 
@@ -624,26 +938,39 @@ def create_dat_hash_dict_xml(datroot):
         }
     return result
 
+def read_dat_header(dat_path):
+    '''
+    returns a dict of every field in the dat <header>, parsing stops as soon as the
+    header is closed so the game entries are never read
+    results are cached per (path, mtime, size) so repeated lookups are free
+    '''
+    stat = os.stat(dat_path)
+    cache_key = (dat_path, stat.st_mtime_ns, stat.st_size)
+    if cache_key in dat_header_cache:
+        return dat_header_cache[cache_key]
+    header = {}
+    with open(dat_path, 'rb') as f:
+        for event, elem in etree.iterparse(f, events=('end',)):
+            if elem.tag == 'header':
+                for field in elem:
+                    if isinstance(field.tag, str):
+                        header[field.tag] = field.text
+                break
+    dat_header_cache[cache_key] = header
+    return header
+
 def get_dat_header_info(dat_path,field):
-    tree = ET.parse(dat_path)
-    root = tree.getroot()
-    try:
-        tag_data = root.find('header/'+field).text
-        return tag_data
-    except:
+    tag_data = read_dat_header(dat_path).get(field)
+    if tag_data is None:
         return ''
+    return tag_data
 
 def get_dat_author(dat_path):
-    tree = ET.parse(dat_path)
-    root = tree.getroot()
-    author = root.find('header/author').text
+    author = read_dat_header(dat_path)['author']
     return author
 
 
 def get_dat_name(dat_path):
-    tree = ET.parse(dat_path)
-    root = tree.getroot()
-    name = root.find('header/name').text
+    name = read_dat_header(dat_path)['name']
     name = html.unescape(name)
     return name
-    
\ No newline at end of file
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import zipfile
+import threading
+from modules.cache import script_dir
+
+
+'''
+CHD build ledger, an append-only json lines file recording every build so an interrupted
+run can be resumed.  a build writes a 'started' record before chdman runs and a 'done'
+or 'failed' record once it finishes, the last record for an output path wins
+'''
+ledger_path = os.path.join(script_dir, 'build_ledger.jsonl')
+
+
+def source_fingerprint(zip_path):
+    '''
+    returns the size, mtime and member crc set of a source zip, the crcs come from the
+    zip directory so nothing is decompressed
+    '''
+    stat = os.stat(zip_path)
+    with zipfile.ZipFile(zip_path, 'r') as zip_file:
+        crcs = sorted(f'{file_info.CRC:08x}' for file_info in zip_file.infolist()
+                      if not file_info.filename.startswith('__MACOSX/'))
+    return {'path':os.path.abspath(zip_path), 'size':stat.st_size, 'mtime_ns':stat.st_mtime_ns, 'crcs':crcs}
+
+
+def source_unchanged(recorded, zip_path):
+    '''
+    a source is unchanged if size and mtime match, if only the mtime changed the crc
+    set is compared so a touched zip doesn't force a rebuild
+    '''
+    try:
+        stat = os.stat(zip_path)
+        if recorded['size'] == stat.st_size and recorded['mtime_ns'] == stat.st_mtime_ns:
+            return True
+        return recorded['size'] == stat.st_size and recorded['crcs'] == source_fingerprint(zip_path)['crcs']
+    except (OSError, zipfile.BadZipFile):
+        return False
+
+
+class BuildLedger:
+    '''
+    the ledger is replayed into a chd path -> last record dict when opened, a torn last
+    line from a crash is ignored.  each record is flushed and fsynced before the build
+    it describes continues, so the ledger never claims more than what is on disk
+    '''
+    def __init__(self, path=ledger_path, chdman_version=None):
+        self.path = path
+        self.chdman_version = chdman_version
+        self.lock = threading.Lock()
+        self.records = {}
+        lines = 0
+        torn = False
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    lines += 1
+                    torn = not line.endswith('\n')
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.records[record['chd_path']] = record
+        except FileNotFoundError:
+            pass
+        # superseded records are dropped once they outnumber the live ones
+        if lines > 2 * len(self.records) + 100:
+            self.compact()
+        self.file = open(path, 'a', encoding='utf-8')
+        if torn:
+            # end the torn line so the next record starts on a line of its own
+            self.file.write('\n')
+
+    def compact(self):
+        temp_path = self.path+'.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for record in self.records.values():
+                f.write(json.dumps(record)+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def append(self, record):
+        record['time'] = time.time()
+        with self.lock:
+            self.records[record['chd_path']] = record
+            self.file.write(json.dumps(record)+'\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    def started(self, job, source):
+        self.append({'status':'started', 'chd_path':os.path.abspath(job['chd_path']),
+                     'source':source, 'chdman':self.chdman_version})
+
+    def done(self, job, source, sha1):
+        stat = os.stat(job['chd_path'])
+        self.append({'status':'done', 'chd_path':os.path.abspath(job['chd_path']),
+                     'source':source, 'chdman':self.chdman_version, 'sha1':sha1,
+                     'size':stat.st_size, 'mtime_ns':stat.st_mtime_ns})
+
+    def failed(self, job, source, error):
+        self.append({'status':'failed', 'chd_path':os.path.abspath(job['chd_path']),
+                     'source':source, 'chdman':self.chdman_version, 'error':error})
+
+    def lookup(self, chd_path):
+        '''
+        returns the last record for a chd, symlinked chds resolve to the chd they link to
+        '''
+        record = self.records.get(os.path.abspath(chd_path))
+        if not record and os.path.islink(chd_path):
+            record = self.records.get(os.path.realpath(chd_path))
+        return record
+
+    def finished(self, record, chd_path):
+        # a finished chd is still the file the done record describes
+        if not record or record['status'] != 'done':
+            return False
+        try:
+            stat = os.stat(chd_path)
+        except OSError:
+            return False
+        return record['size'] == stat.st_size and record['mtime_ns'] == stat.st_mtime_ns
+
+    def partial(self, chd_path):
+        '''
+        true if the last record for chd_path is a build which was interrupted or failed,
+        the file on disk is what chdman wrote before it stopped.  chds the ledger doesn't
+        know, e.g. built outside slupdate, are never partial
+        '''
+        record = self.lookup(chd_path)
+        return bool(record) and record['status'] in ('started', 'failed')
+
+    def stale(self, chd_path):
+        '''
+        true if chd_path was built but its size or mtime changed since, e.g. it was touched
+        or copied without keeping mtimes.  see refresh
+        '''
+        record = self.lookup(chd_path)
+        return bool(record) and record['status'] == 'done' and not self.finished(record, chd_path)
+
+    def refresh(self, chd_path, sha1):
+        '''
+        records the current size and mtime of a stale chd if its header sha1 is still the
+        one recorded when it was built, returns True if it was
+        '''
+        record = self.lookup(chd_path)
+        if record['sha1'] != sha1:
+            return False
+        stat = os.stat(chd_path)
+        self.append({**record, 'size':stat.st_size, 'mtime_ns':stat.st_mtime_ns})
+        return True
+
+    def finished_sha1(self, chd_path, source_rom=None):
+        '''
+        returns the recorded sha1 of a finished chd, only if the chd is the same file that
+        was built and, when source_rom is given, was built from the same source zip.
+        otherwise returns None
+        '''
+        record = self.lookup(chd_path)
+        if not self.finished(record, chd_path):
+            return None
+        if source_rom and (record['source']['path'] != os.path.abspath(source_rom)
+                           or not source_unchanged(record['source'], source_rom)):
+            return None
+        return record['sha1']
@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+
+'''
+stage instrumentation, each stage records calls, wall time, cpu time and items processed
+every time it runs.  peak memory is only recorded while tracemalloc is running, see
+start_memory_tracking.  cpu time is for the whole process so stages which run worker
+threads include them, stages running at the same time all count the same cpu time
+'''
+stage_stats = {}
+stage_lock = threading.Lock()
+# stages currently running, a memory peak is credited to every stage active when it happened
+active_stages = []
+
+
+def reset_stages():
+    with stage_lock:
+        stage_stats.clear()
+
+
+def start_memory_tracking():
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def stop_memory_tracking():
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def credit_memory_peak():
+    # must hold stage_lock, the traced peak since the last reset goes to every active stage
+    peak = tracemalloc.get_traced_memory()[1]
+    for record in active_stages:
+        record['peak_bytes'] = max(record['peak_bytes'], peak)
+    tracemalloc.reset_peak()
+
+
+@contextmanager
+def stage(name, items=0):
+    '''
+    times the block as a run of stage name, the yielded dict's 'items' can be updated
+    by the block when the item count isn't known up front
+    '''
+    record = {'items':items, 'peak_bytes':0}
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        with stage_lock:
+            credit_memory_peak()
+            active_stages.append(record)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield record
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        with stage_lock:
+            if tracing and tracemalloc.is_tracing():
+                credit_memory_peak()
+            if record in active_stages:
+                active_stages.remove(record)
+            stats = stage_stats.setdefault(name, {'calls':0, 'wall':0.0, 'cpu':0.0, 'items':0, 'peak_mb':None})
+            stats['calls'] += 1
+            stats['wall'] += wall
+            stats['cpu'] += cpu
+            stats['items'] += record['items']
+            if tracing:
+                stats['peak_mb'] = max(stats['peak_mb'] or 0, record['peak_bytes'] / 2**20)
+
+
+def stage_report():
+    with stage_lock:
+        return {name : dict(stats) for name, stats in stage_stats.items()}
+
+
+def print_stage_report():
+    report = stage_report()
+    if not report:
+        return
+    print(f"\n{'stage':<20}{'calls':>7}{'wall s':>10}{'cpu s':>10}{'items':>10}{'peak MB':>10}")
+    for name, stats in report.items():
+        peak = f"{stats['peak_mb']:.1f}" if stats['peak_mb'] is not None else '-'
+        print(f"{name:<20}{stats['calls']:>7}{stats['wall']:>10.2f}{stats['cpu']:>10.2f}{stats['items']:>10}{peak:>10}")
+
+
+def write_stage_report(path, run_info=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({**(run_info or {}), 'stages':stage_report()}, f, indent=1)
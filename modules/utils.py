@@ -5,6 +5,11 @@ import os
 import re
 import pickle
 import pprint
+import threading
+
+# os.scandir listings keyed on directory, see get_dir_index
+dir_index = {}
+dir_index_lock = threading.Lock()
 
 def save_data(data_to_save,name,directory):
     with open(directory+os.sep+name+'.cache', 'wb') as f:
@@ -38,6 +43,66 @@ def convert_xml(file, comments=False):
     my_ordered_dict=xmltodict.parse(xml_content, process_comments=comments, force_list=('info','rom',))
     return my_ordered_dict
     
+def reset_dir_index():
+    '''
+    forgets all directory listings, called at the start of each run so changes
+    made between runs are picked up
+    '''
+    with dir_index_lock:
+        dir_index.clear()
+
+def get_dir_index(directory):
+    '''
+    returns a name -> os.DirEntry dict for the directory, each directory is only listed
+    once until reset_dir_index is called.  DirEntry objects cache their stat result
+    so repeated size/mtime lookups don't go back to the filesystem
+    missing or unreadable directories return an empty dict
+    '''
+    with dir_index_lock:
+        if directory in dir_index:
+            return dir_index[directory]
+    try:
+        with os.scandir(directory) as entries:
+            listing = {entry.name : entry for entry in entries}
+    except OSError:
+        listing = {}
+    with dir_index_lock:
+        return dir_index.setdefault(directory, listing)
+
+def get_indexed_entry(path):
+    '''
+    returns the DirEntry for a file path from its directory listing, or None
+    '''
+    directory, name = os.path.split(path)
+    return get_dir_index(directory).get(name)
+
+def indexed_isfile(path):
+    '''
+    os.path.isfile replacement using the directory listing index
+    a name missing from the listing is checked with os.path.isfile, case insensitive
+    filesystems and unicode normalisation (macOS) can match a name the listing doesn't
+    '''
+    entry = get_indexed_entry(path)
+    if entry is None:
+        return os.path.isfile(path)
+    try:
+        return entry.is_file()
+    except OSError:
+        return False
+
+def indexed_stat(path):
+    '''
+    returns the stat result of a file using the directory listing index, or None if
+    path isn't a file.  names missing from the listing fall back as in indexed_isfile
+    '''
+    entry = get_indexed_entry(path)
+    try:
+        if entry is None:
+            return os.stat(path) if os.path.isfile(path) else None
+        return entry.stat() if entry.is_file() else None
+    except OSError:
+        return None
+
 def history(search=None):
     import readline
     for i in range(readline.get_current_history_length()):
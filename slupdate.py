@@ -8,7 +8,11 @@ https://github.com/ldolse/slupdate
 import os
 import re
 import sys
+import time
+import cProfile
+import argparse
 import inquirer
+from concurrent.futures import ThreadPoolExecutor
 import builtins
 
 try:
@@ -21,10 +25,14 @@ except:
 # bit of a hack to pass the script dir to the chd module
 builtins.script_dir = script_dir
 
-from modules.utils import save_data,restore_dict,convert_xml
+from modules.utils import save_data,restore_dict,convert_xml,reset_dir_index,get_dir_index,indexed_isfile
+from modules.cache import prune_file_cache
 from modules.dat import *
 from modules.chd import *
 from modules.mapping import *
+from modules.audit import audit_chd_library, print_audit_summary
+from modules.ledger import BuildLedger
+from modules.profiling import stage, reset_stages, start_memory_tracking, stop_memory_tracking, print_stage_report, write_stage_report
 
 
 
@@ -34,6 +42,11 @@ __version__ = '.1'
 # Require at least Python 3.2
 assert sys.version_info >= (3, 2)
 
+# exit status for the batch commands
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_CONFIG = 2
+
 
 settings = restore_dict('settings')
 user_answers = restore_dict('user_answers')
@@ -97,6 +110,8 @@ menu_msgs = {'0' : 'Main Menu, select an option',
 # This allows completed functions to go back to their parent menu automatically
 menu_lists = {'0' : [('1. Mapping Functions', 'map'),
                      ('2. CHD Builder', '2'),
+                     ('3. Audit CHD Library', 'audit_function'),
+                     ('4. Map All Configured Platforms', 'map_all_function'),
                      #('3. Assisted Title/Disc Mapping', '3'),
                      #('4. Create New Entries','entry_create_function'),
                      ('5. Settings','5'),
@@ -121,7 +136,8 @@ menu_lists = {'0' : [('1. Mapping Functions', 'map'),
                     ('b. Configure Root DAT/ROM Directories (ROMvault)', 'root_dirs_function'),
                     ('c. Configure DAT/ROM Platform Directories', 'dat'),
                     ('d. Destination folder for CHDs', 'chd_dir_function'),
-                    ('e. Back', '0')],
+                    ('e. Parallel Worker Counts', 'workers_function'),
+                    ('f. Back', '0')],
              'dat' : [('Add Directories','platform_dat_rom_function'),
                       ('Remove DATs','del_dats_function'),
                       ('Back', '5')],
@@ -195,55 +211,116 @@ def list_menu(key, options, prompt):
     return answer
 
 
-def find_dat_matches(platform,sl_platform_dict,dathash_platform_dict):
+def find_dat_matches(platform,sl_platform_dict,dathash_platform_dict,quiet=False,executor=None,root_limits=None):
     '''
-    matches source hash fingerprints to the dat fingerprint dicts
+    matches source hash fingerprints against one merged index of all the platform's dats
+    dats are tried in priority (settings) order.  runs as three stages:
+      - match: look up every part's fingerprint, collecting the candidate dat entries
+      - verify: check the highest priority candidate zip of every part in a thread pool,
+        lower priority candidates are only checked for parts where every earlier one failed
+      - resolve: walk the parts in softlist order, annotating the first valid candidate
     updates the softlist dict to point to the dat for that source
+    quiet skips printing the matches and summary, executor and root_limits are passed
+    to verify_source_zips.  returns the summary counts
     '''
-    for datfile, dathashdict in dathash_platform_dict['hashes'].items():
-        dat_group = get_dat_group(datfile)
+    dat_hashes = dathash_platform_dict['hashes']
+    dat_groups = dathash_platform_dict['dat_group']
+    if 'source_index' not in dathash_platform_dict:
+        build_source_index(dathash_platform_dict)
+
+    # match stage
+    with stage('match') as record:
+        matched_parts = []
+        chds_exist = {}
+        # chd platform directory listing, only softlist entry directories which exist are listed
+        chd_platform_index = get_dir_index(settings['chd']+os.sep+platform)
         for sl_title, sl_data in sl_platform_dict.items():
-            dat_name_list = []
-            chds_exist = False
+            chds_exist[sl_title] = False
             for disc, disc_data in sl_data['parts'].items():
                 if 'source_rom' in disc_data:
-                    continue # skip when a source ROM was identified from an earlier DAT
-                if 'chd_filename' in disc_data:
+                    continue # skip when a source ROM was already identified
+                if 'chd_filename' in disc_data and sl_title in chd_platform_index:
                     chd_path = settings['chd']+os.sep+platform+os.sep+sl_title+os.sep+disc_data['chd_filename']+'.chd'
-                    if os.path.isfile(chd_path):
+                    if indexed_isfile(chd_path):
                         # add chd path to a list, check for unique files later
                         disc_data.update({'chd_found':True})
-                        chds_exist = True
+                        chds_exist[sl_title] = True
                 # get source hash key based on crc or sha
                 if 'source_sha' in disc_data:
                     sourcehash = disc_data['source_sha']
                 else:
                     continue
-                if sourcehash in dathashdict:
-                    # add the dat source to the entry
-                    disc_data['source_dat'] = datfile
-                    # add the dat group to the entry
-                    disc_data['source_group'] = dat_group
-                    dat_name_list.append(dathashdict[sourcehash]['name'])
-                    if 'softlist_matches' not in dathashdict[sourcehash]:
-                        dathashdict[sourcehash]['softlist_matches'] = []
-                    dathashdict[sourcehash]['softlist_matches'].append(sl_title)
-
-                    # set boolean flag at the softlist level to flag a match
-                    sl_platform_dict[sl_title].update({'source_found':True})
-
-                    # pop this from the redump list to enable future mapping of remaining entries to redump
-                    if dathashdict[sourcehash]['name'] in dathash_platform_dict['redump_unmatched'][datfile]:
-                        dathash_platform_dict['redump_unmatched'][datfile].pop(dathashdict[sourcehash]['name'])
-            # check to see if there are valid zips for this softlist entry, creates 'source_rom' key(s) if so
-            zip_name = find_rom_zips(datfile,sl_data,dathashdict,settings[platform])
-            if zip_name:
-                dat_zips = dict(zip(dat_name_list,zip_name))
-                print('\nMatch Found:\n  Softlist: '+sl_data['description'])
-                for datname,zipname in dat_zips.items():
-                    print('       Dat: '+datname+'\n       Zip: '+zipname)
-                    if chds_exist:
-                        print('       CHD(s) for this title found')
+                candidates = get_source_dats(dathash_platform_dict,sourcehash)
+                if not candidates:
+                    continue
+                matched_parts.append((sl_title, disc, sourcehash, list(candidates)))
+        record['items'] = len(matched_parts)
+
+    # verify stage, one round per candidate rank so each part's zip is checked once unless it fails
+    zip_results = {}
+    pending = matched_parts
+    rank = 0
+    while pending:
+        zip_checks = {}
+        for sl_title, disc, sourcehash, candidates in pending:
+            datfile = candidates[rank]
+            if (datfile, sourcehash) not in zip_results:
+                zip_checks.setdefault((datfile, sourcehash), (datfile, disc, dat_hashes[datfile][sourcehash]))
+        check_keys = list(zip_checks)
+        zip_results.update(zip(check_keys, verify_source_zips([zip_checks[key] for key in check_keys],
+                                                              settings[platform],settings.get('zip_workers',4),
+                                                              executor,root_limits)))
+        pending = [part for part in pending
+                   if not zip_results[(part[3][rank], part[2])] and len(part[3]) > rank + 1]
+        rank += 1
+
+    # resolve stage
+    with stage('match'):
+        dat_matches = {}
+        for sl_title, disc, sourcehash, candidates in matched_parts:
+            sl_data = sl_platform_dict[sl_title]
+            disc_data = sl_data['parts'][disc]
+            # dat names and zips matched for this entry, grouped by dat for the summary
+            entry_matches = dat_matches.setdefault(sl_title, {})
+            for datfile in candidates:
+                dat_game_entry = dat_hashes[datfile][sourcehash]
+                # add the dat source to the entry
+                disc_data['source_dat'] = datfile
+                # add the dat group to the entry
+                disc_data['source_group'] = dat_groups[datfile]
+                if 'softlist_matches' not in dat_game_entry:
+                    dat_game_entry['softlist_matches'] = []
+                dat_game_entry['softlist_matches'].append(sl_title)
+
+                # set boolean flag at the softlist level to flag a match
+                sl_data.update({'source_found':True})
+
+                # pop this from the redump list to enable future mapping of remaining entries to redump
+                if dat_game_entry['name'] in dathash_platform_dict['redump_unmatched'][datfile]:
+                    dathash_platform_dict['redump_unmatched'][datfile].pop(dat_game_entry['name'])
+
+                # use the first valid zip, lower priority dats are only used if there isn't one
+                if datfile not in entry_matches:
+                    entry_matches[datfile] = []
+                goodzip = zip_results[(datfile, sourcehash)]
+                if goodzip:
+                    dat_game_entry.update({'source_rom':goodzip})
+                    disc_data.update({'source_rom':goodzip})
+                    entry_matches[datfile].append((dat_game_entry['name'],os.path.basename(goodzip)))
+                    break
+                entry_matches[datfile].append((dat_game_entry['name'],'No Valid Zip'))
+
+    for sl_title, entry_matches in dat_matches.items():
+        if quiet:
+            break
+        for datfile, matches in entry_matches.items():
+            if all(zipname == 'No Valid Zip' for datname, zipname in matches):
+                continue
+            print('\nMatch Found:\n  Softlist: '+sl_platform_dict[sl_title]['description'])
+            for datname,zipname in matches:
+                print('       Dat: '+datname+'\n       Zip: '+zipname)
+                if chds_exist[sl_title]:
+                    print('       CHD(s) for this title found')
     # Count the total number of softlist entries
     total_softlist_entries = len(sl_platform_dict)
     # count the total number of entries with source references
@@ -258,6 +335,13 @@ def find_dat_matches(platform,sl_platform_dict,dathash_platform_dict):
     total_source_dat = sum(1 for softlist_entry in sl_platform_dict.values() for part in softlist_entry['parts'].values() if 'source_dat' in part)
     # Count the number of parts that have a 'source_rom' entry
     total_source_rom = len(list(part['source_rom'] for softlist_entry in sl_platform_dict.values() for part in softlist_entry['parts'].values() if 'source_rom' in part))
+    # get the stats on source groups 
+    source_stats = get_source_stats(sl_platform_dict)
+    summary = {'entries':total_softlist_entries, 'entries_found':total_source_found, 'parts':total_parts,
+               'source_refs':total_source_ref, 'source_dats':total_source_dat, 'source_roms':total_source_rom,
+               'chds':chd_count, 'source_stats':source_stats}
+    if quiet:
+        return summary
 
     print(f'found:\n  {total_source_ref} / {total_parts} individual discs contain source references')
     print(f'  {total_source_dat} individual discs can be matched to dat sources')
@@ -265,9 +349,8 @@ def find_dat_matches(platform,sl_platform_dict,dathash_platform_dict):
     print(f'  {total_source_rom} valid zip files')
     print(f'  {chd_count} chds already exist in the destination directory\n')
     print('\nDAT Groups:')
-    # get the stats on source groups 
-    source_stats = get_source_stats(sl_platform_dict)
     print_source_stats(source_stats,total_source_ref)
+    return summary
 
 
 def get_configured_platforms(action_type):
@@ -310,29 +393,20 @@ def automap_function(platform):
 
     # process each DAT to build a list of fingerprints
     print('processing '+platform+' DAT Files')
+    # directory listings are rebuilt for every run
+    reset_dir_index()
     if platform not in dat_dict:
         dat_dict.update({platform:{}})
-    for dat in settings[platform]:
-        raw_dat_dict = convert_xml(dat)
-        build_dat_dict(dat,raw_dat_dict['datafile'],dat_dict[platform])
-    # hashes may be identical across DAT groups, prioritise redump hashes and delete dupes in others
-    remove_dupe_dat_entries(dat_dict[platform])
-
-    # process the software list into a dict, creating hash based fingerprints from comments
-    print('processing '+platform+' software list')
-    process_comments = True
-    raw_sl_dict = convert_xml(settings['sl_dir']+os.sep+platform+'.xml',process_comments)
-    softdict = dict(raw_sl_dict['softwarelist'])
-    if platform not in softlist_dict:
-        softlist_dict.update({platform:{}})
-    # build the dict object with relevant softlist data for this script, return bool whether crc source keys are needed
-    build_sl_dict(softdict['software'], softlist_dict[platform])
-
-    # iterate through each fingerprint in the software list and search for matching hashes
-    find_dat_matches(platform,softlist_dict[platform],dat_dict[platform])
-    # flag that this stage is completed for this platform
-    if platform not in mapping_stage['source_map']:
-        mapping_stage['source_map'].append(platform)
+    # dats are parsed in parallel but merged in settings order
+    build_platform_dat_dict(list(settings[platform]),dat_dict[platform],settings.get('dat_workers'))
+    # drop cached fingerprints for dats which are no longer configured for any platform
+    prune_file_cache('dats',[dat for name, configured in get_configured_platforms('map') for dat in settings[configured]])
+
+    load_zip_cache()
+    map_platform(platform)
+    prune_file_cache('softlists',[settings['sl_dir']+os.sep+configured+'.xml' for name, configured in get_configured_platforms('map')])
+    save_zip_cache()
+    print('zip cache: {hits} hits, {misses} misses, {invalidations} invalidations'.format(**zip_cache_stats))
     '''
     print('Next step will be to map entries based on name and disc serial number')
     print('This will require connecting to redump once for each platform to get additional info')
@@ -347,6 +421,84 @@ def automap_function(platform):
 
 
 
+def map_platform(platform,quiet=False,executor=None,root_limits=None):
+    '''
+    matches the platform softlist against the platform dat dict, which must already be
+    built.  returns the summary counts from find_dat_matches and the duplicate dat
+    entries removed, quiet leaves the progress messages to the caller's summary
+    '''
+    # hashes may be identical across DAT groups, prioritise redump hashes and delete dupes in others
+    dupe_count = remove_dupe_dat_entries(dat_dict[platform],quiet)
+
+    # process the software list into a dict, creating hash based fingerprints from comments
+    if not quiet:
+        print('processing '+platform+' software list')
+    # build the dict object with relevant softlist data for this script, cached until the hash xml changes
+    softlist_dict.update({platform:load_sl_dict(settings['sl_dir']+os.sep+platform+'.xml',quiet)})
+
+    # iterate through each fingerprint in the software list and search for matching hashes
+    summary = find_dat_matches(platform,softlist_dict[platform],dat_dict[platform],quiet,executor,root_limits)
+    summary['dat_dupes'] = dupe_count
+    # flag that this stage is completed for this platform
+    if platform not in mapping_stage['source_map']:
+        mapping_stage['source_map'].append(platform)
+    return summary
+
+
+def map_all_function(platforms=None):
+    '''
+    maps every configured platform, settings['map_workers'] platforms at a time.  dats
+    configured for several platforms are parsed once and the zip checks of all the
+    platforms share one thread pool and the per ROM folder limits.  the per platform
+    output is replaced by one summary at the end.  returns the summaries by platform,
+    None for platforms which failed
+    '''
+    if platforms is None:
+        platforms = [platform for name, platform in get_configured_platforms('map')]
+    print('mapping '+', '.join(platforms))
+    reset_dir_index()
+    # every dat is parsed once up front, each platform then loads its own copy from the cache
+    cache_dat_fingerprints([dat for platform in platforms for dat in settings[platform]],settings.get('dat_workers'))
+    prune_file_cache('dats',[dat for name, configured in get_configured_platforms('map') for dat in settings[configured]])
+    load_zip_cache()
+    zip_workers = settings.get('zip_workers',4)
+    root_limits = {}
+
+    def map_one(platform):
+        dat_dict[platform] = {}
+        build_platform_dat_dict(list(settings[platform]),dat_dict[platform],1)
+        return map_platform(platform,True,zip_executor,root_limits)
+
+    summaries = {}
+    rom_folders = sum(len(settings[platform]) for platform in platforms)
+    with ThreadPoolExecutor(max_workers=zip_workers*max(rom_folders,1)) as zip_executor:
+        with ThreadPoolExecutor(max_workers=settings.get('map_workers',2)) as platform_executor:
+            futures = {platform : platform_executor.submit(map_one,platform) for platform in platforms}
+            for platform, future in futures.items():
+                try:
+                    summaries[platform] = future.result()
+                except Exception as e:
+                    print('mapping '+platform+' failed: '+str(e))
+                    summaries[platform] = None
+    prune_file_cache('softlists',[settings['sl_dir']+os.sep+configured+'.xml' for name, configured in get_configured_platforms('map')])
+    save_zip_cache()
+    print_map_summary(summaries)
+    print('zip cache: {hits} hits, {misses} misses, {invalidations} invalidations'.format(**zip_cache_stats))
+    return summaries
+
+
+def print_map_summary(summaries):
+    print('\n{:<14}{:>9}{:>13}{:>11}{:>10}{:>10}{:>7}'.format('platform','entries','with source','dat dupes','dat hits','zips','chds'))
+    for platform, summary in summaries.items():
+        if summary is None:
+            print(f'{platform:<14}   failed')
+            continue
+        entries = f"{summary['entries_found']}/{summary['entries']}"
+        sources = f"{summary['source_refs']}/{summary['parts']}"
+        print(f"{platform:<14}{entries:>9}{sources:>13}{summary['dat_dupes']:>11}{summary['source_dats']:>10}"
+              f"{summary['source_roms']:>10}{summary['chds']:>7}")
+
+
 def name_serial_automap_function(platform):
     from modules.mapping import name_serial_map
     name_serial_map(platform, softlist_dict[platform],dat_dict[platform])
@@ -355,18 +507,27 @@ def name_serial_automap_function(platform):
         mapping_stage['name_serial_map'].append(platform)
         
 
-def chd_builder(platform):
+def chd_builder(platform, confirm=None):
     '''
     checks each soft list entry for a matched source rom and builds chds using those ROM 
     sources.  CHD hash is added to the soft-dict.  If a CHD already exists in the build 
     directory it's skipped, but there is a flag to enable grabbing hashes for built CDs.
+    every buildable part becomes a job, jobs are run settings['chd_workers'] at a time
+    builds are recorded in the build ledger, chds left by an interrupted or failed build
+    are rebuilt and sha1s of finished chds are taken from the ledger
+    confirm decides whether new hashes are written to the softlist, the user is asked if
+    it is None.  returns the build results, or None if chdman can't be run
     '''
     new_hashes = False
-    built_sources = {}
-    discontinue = False
+    chdman_version = chdman_info()
+    if not chdman_version:
+        print('chdman is missing, please install a recent version')
+        return None
+    ledger = BuildLedger(chdman_version=chdman_version)
+    # source zip -> build job, parts sharing a source are linked to the first chd built
+    source_jobs = {}
+    jobs = []
     for soft, soft_data in softlist_dict[platform].items():
-        if discontinue:
-            break
         for disc_data in soft_data['parts'].values():
             if 'source_rom' in disc_data:
                 # create platform directory
@@ -377,80 +538,89 @@ def chd_builder(platform):
                     os.mkdir(chd_dir)
                 chd_name = disc_data['chd_filename']+'.chd'
                 chd_path = os.path.join(chd_dir,chd_name)
-                if not os.path.isfile(chd_path):
-                    print('\nbuilding chd for '+soft_data['description']+':')
-                    print('            CHD: '+chd_name)
-                    print('     Source Zip: '+os.path.basename(disc_data['source_rom']))
-
-                    if disc_data['source_rom'] not in built_sources:
-                        '''
-                        check the dat group here for any special handling that will be needed
-                        known things to handle:
-                          - Redump and cdi - need to rewrite the cue file (todo)
-                          - No-Intro - Cue file data doesn't match filenames (partial support)
-                        '''
-                        dat_group = get_dat_group(disc_data['source_dat'])
-                        special_logic = {'dat_group':dat_group}
-                        if dat_group == 'no-intro':
-                            game_entry = dat_dict[platform]['hashes'][disc_data['source_dat']][disc_data['source_sha']]
-                            special_logic.update(game_entry)
-                        elif dat_group == 'redump' and platform == 'cdi':
-                            # placeholder
-                            pass
-                        else:
-                            special_logic = None
+                if os.path.isfile(chd_path):
+                    if ledger.stale(chd_path):
+                        # a touched or copied chd is kept if its header still has the built sha1
                         try:
-                            error = create_chd_from_zip(disc_data['source_rom'],chd_path,settings,special_logic)
-                            if not error:
-                                built_sources.update({disc_data['source_rom']:chd_path})
-                            else:
-                                print(error)
-                                continue
-                        except:
-                            print('CHD Creation Failed')
-                            if os.path.isfile(chd_path):
-                                try:
-                                    os.remove(chd_path)
-                                except:
-                                    print('Failed to delete partial file:\n'+chd_path)
-                                    print('Please ensure this is deleted to avoid corrupted files/hashes')
-                            continue_build = inquirer.confirm('Do you want to continue?', default=False)
-                            if continue_build:
-                                continue
-                            else:
-                                discontinue = True
-                                break
-                    # if the exact same chd was built earlier then just symlink to it
-                    # these symlinks aren't cross platform, will revisit this
-                    elif disc_data['source_rom'] in built_sources:
-                        os.symlink(built_sources[disc_data['source_rom']],chd_path)
-                        built_sources.update({disc_data['source_rom']:chd_path})
-                else:
+                            if not ledger.refresh(chd_path,chdman_info(chd_path)):
+                                print('chd changed since it was built, not using its recorded sha1: '+chd_name)
+                        except (ChdHeaderError, OSError) as e:
+                            print(e)
+                    if not ledger.partial(chd_path):
+                        continue
+                        #print('chd for '+soft_data['description']+' already exists, skipping')
+                    print('removing partial chd from an interrupted or failed build: '+chd_name)
+                    os.remove(chd_path)
+                if disc_data['source_rom'] in source_jobs:
+                    source_jobs[disc_data['source_rom']]['links'].append(chd_path)
                     continue
-                    #print('chd for '+soft_data['description']+' already exists, skipping')
-                # if the chd was created as a part of this run or if the flag to trust existing chds is enabled check the sha1 against the softlist
-                if os.path.isfile(chd_path):
-                    if disc_data['source_rom'] in built_sources or get_sha_from_existing_chd:
+                '''
+                check the dat group here for any special handling that will be needed
+                known things to handle:
+                  - Redump and cdi - need to rewrite the cue file (todo)
+                  - No-Intro - Cue file data doesn't match filenames (partial support)
+                '''
+                dat_group = get_dat_group(disc_data['source_dat'])
+                special_logic = {'dat_group':dat_group}
+                if dat_group == 'no-intro':
+                    game_entry = dat_dict[platform]['hashes'][disc_data['source_dat']][disc_data['source_sha']]
+                    special_logic.update(game_entry)
+                elif dat_group == 'redump' and platform == 'cdi':
+                    # placeholder
+                    pass
+                else:
+                    special_logic = None
+                job = {'description':soft_data['description'],
+                       'chd_path':chd_path,
+                       'source_rom':disc_data['source_rom'],
+                       'special_info':special_logic,
+                       'links':[]}
+                source_jobs[disc_data['source_rom']] = job
+                jobs.append(job)
+
+    # builds are only started when the temp and chd directories have room for them
+    budget = DiskBudget()
+    results = run_chd_jobs(jobs,settings,settings.get('chd_workers',1),budget,ledger,chdman_version)
+    ledger.close()
+    print_build_report(results,budget,settings)
+    built_sources = {result['job']['source_rom'] for result in results if not result['error']}
+
+    # if the chd was created as a part of this run or if the flag to trust existing chds is enabled check the sha1 against the softlist
+    for soft, soft_data in softlist_dict[platform].items():
+        for disc_data in soft_data['parts'].values():
+            if 'source_rom' not in disc_data:
+                continue
+            chd_name = disc_data['chd_filename']+'.chd'
+            chd_path = os.path.join(settings['chd'],platform,soft,chd_name)
+            if os.path.isfile(chd_path):
+                new_chd_hash = ledger.finished_sha1(chd_path,disc_data['source_rom'])
+                if not new_chd_hash and (disc_data['source_rom'] in built_sources or get_sha_from_existing_chd):
+                    try:
                         new_chd_hash = chdman_info(chd_path)
-                        if new_chd_hash == disc_data['chd_sha1']:
-                            print('\nHash matches softlist: '+chd_name+'\n')
-                        else:
-                            new_hashes = True
-                            print('\nUpdated hash for softlist: '+chd_name+'\n')
-                            disc_data.update({'new_sha1':new_chd_hash})
-                    else:
+                    except ChdHeaderError as e:
+                        print(e)
                         continue
+                if new_chd_hash:
+                    if new_chd_hash == disc_data['chd_sha1']:
+                        print('\nHash matches softlist: '+chd_name+'\n')
+                    else:
+                        new_hashes = True
+                        print('\nUpdated hash for softlist: '+chd_name+'\n')
+                        disc_data.update({'new_sha1':new_chd_hash})
                         
     if new_hashes:
-        write_new_hashes = inquirer.confirm('Update the Software List with new CHD Hashes?', default=False)
-        if write_new_hashes:
+        if confirm is None:
+            confirm = inquirer.confirm('Update the Software List with new CHD Hashes?', default=False)
+        if confirm:
             update_softlist_chd_sha1s(settings['sl_dir']+os.sep+platform+'.xml',softlist_dict[platform])
+    return results
 
 
 
 def chd_build_function(platform=None):
-    if not is_greater_than_0_176(chdman_info()):
-        print('Outdated Chdman, please upgrade to a recent version')
+    chdman_version = chdman_info()
+    if not chdman_version or not is_greater_than_0_176(chdman_version):
+        print('chdman is missing or outdated, please install a recent version')
         return None
     if not platform:
         # get configured platforms and map selected from the returned key
@@ -462,6 +632,20 @@ def chd_build_function(platform=None):
     if build:
         chd_builder(platform)
 
+def audit_function():
+    '''
+    compares every CHD in the destination directory with the software lists and
+    writes a json report of matching, mismatching, missing and orphaned CHDs
+    '''
+    if 'chd' not in settings:
+        print('Please configure the CHD destination directory first\n')
+        return
+    report_path = os.path.join(script_dir,'chd_audit.json')
+    report = audit_chd_library(settings,list(consoles.values()),report_path,settings.get('audit_workers',8))
+    print('\nCHD audit:')
+    print_audit_summary(report)
+    print('report written to '+report_path)
+
 def save_function():
     confirm_message = menu_msgs['save']
     save = inquirer.confirm(confirm_message, default=False)
@@ -507,6 +691,23 @@ def chd_dir_function():
     single_dir_function('chd','CHD Destination Directory')
     single_dir_function('zip_temp','Temporary Directory for uncompressed ZIP data')
 
+def workers_function():
+    '''
+    configures how much work is run in parallel, blank answers keep the defaults
+    '''
+    worker_settings = {'dat_workers' : 'DAT files parsed at once (default: number of CPUs)',
+                       'zip_workers' : 'Zip files checked at once per ROM directory (default: 4)',
+                       'chd_workers' : 'CHDs built at once (default: 1)',
+                       'map_workers' : 'Platforms mapped at once when mapping all platforms (default: 2)'}
+    for setting, prompt in worker_settings.items():
+        current = str(settings.get(setting, ''))
+        answer = inquirer.text(prompt, default=current,
+                               validate=lambda _, value: value == '' or (value.isdigit() and int(value) > 0))
+        if answer:
+            settings.update({setting : int(answer)})
+        elif setting in settings:
+            settings.pop(setting)
+
 def single_dir_function(dirtype,prompt):
     # queries and stores the software list hash directory
     directory = select_directory(prompt)
@@ -643,8 +844,156 @@ def select_directory(filetype=None,start_dir=None):
             os.chdir(current_path)
 
 
+def collect_built_sha1s(platform):
+    '''
+    loads the platform softlist and sets new_sha1 on every part whose chd in the destination
+    directory was built by this script and doesn't match the softlist.  chds are only
+    trusted if the build ledger has them, or all chds if get_sha_from_existing_chd is set
+    returns the number of changed hashes
+    '''
+    softlist_dict.update({platform:load_sl_dict(settings['sl_dir']+os.sep+platform+'.xml')})
+    ledger = BuildLedger()
+    ledger.close()
+    changed = 0
+    for soft, soft_data in softlist_dict[platform].items():
+        for disc_data in soft_data['parts'].values():
+            if 'chd_filename' not in disc_data:
+                continue
+            chd_path = os.path.join(settings['chd'],platform,soft,disc_data['chd_filename']+'.chd')
+            if not os.path.isfile(chd_path):
+                continue
+            new_chd_hash = ledger.finished_sha1(chd_path)
+            if not new_chd_hash and get_sha_from_existing_chd:
+                try:
+                    new_chd_hash = chdman_info(chd_path)
+                except ChdHeaderError as e:
+                    print(e)
+                    continue
+            if new_chd_hash and new_chd_hash != disc_data.get('chd_sha1'):
+                print('Updated hash for softlist: '+os.path.basename(chd_path))
+                disc_data.update({'new_sha1':new_chd_hash})
+                changed += 1
+    return changed
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Update optical media software lists and build CHDs. '
+                                     'Run without a command for the interactive menus.')
+    parser.add_argument('--profile', action='store_true',
+                        help='write a cProfile dump and a json stage report to the profiles directory')
+    commands = parser.add_subparsers(dest='command', required=True)
+    platform_args = argparse.ArgumentParser(add_help=False)
+    platform_args.add_argument('--platform', action='append', default=[], metavar='PLATFORM',
+                               help='softlist name of a configured platform, e.g. psx.  can be repeated')
+    platform_args.add_argument('--all', action='store_true', help='every configured platform')
+    commands.add_parser('map', parents=[platform_args], help='match softlist sources to DATs and zips')
+    build = commands.add_parser('build', parents=[platform_args], help='map then build CHDs')
+    build.add_argument('--jobs', type=int, help='CHDs built at once, defaults to the chd_workers setting')
+    build.add_argument('--update-softlist', action='store_true', help='write new CHD hashes to the softlist')
+    update = commands.add_parser('update-softlist', parents=[platform_args],
+                                 help='write hashes of CHDs built by slupdate to the softlist')
+    update.add_argument('--yes', action='store_true', help='write the changes, otherwise they are only listed')
+    audit = commands.add_parser('audit', help='audit the CHD library against the softlists')
+    audit.add_argument('--jobs', type=int, help='CHD headers read at once, default 8')
+    return parser.parse_args(argv)
+
+
+def batch_platforms(args):
+    '''
+    returns the platforms a batch command should run on, None if any are not configured
+    '''
+    configured = [platform for name, platform in get_configured_platforms('map')]
+    if args.all:
+        return configured
+    unknown = [platform for platform in args.platform if platform not in configured]
+    if unknown or not args.platform:
+        print('Platforms must be configured in the interactive settings first, configured: '+', '.join(configured))
+        return None
+    return args.platform
+
+
+def batch_main(argv):
+    '''
+    runs a command without any prompts using the saved settings, returns the exit status
+    with --profile the run is profiled and memory is traced for the stage report, both
+    are written to profiles/<time>-<command>.prof and .json in the script directory
+    '''
+    args = parse_args(argv)
+    if not args.profile:
+        return run_batch(args)
+    reset_stages()
+    start_memory_tracking()
+    profiler = cProfile.Profile()
+    started = time.time()
+    profiler.enable()
+    try:
+        status = run_batch(args)
+    finally:
+        profiler.disable()
+        stop_memory_tracking()
+        profile_base = os.path.join(script_dir,'profiles',time.strftime('%Y%m%d-%H%M%S',time.localtime(started))+'-'+args.command)
+        write_stage_report(profile_base+'.json',{'command':argv, 'started':started, 'wall':time.time()-started})
+        profiler.dump_stats(profile_base+'.prof')
+        print_stage_report()
+        print('profile written to '+profile_base+'.prof')
+    return status
+
+
+def run_batch(args):
+    if not settings:
+        settings.update(restore_dict(os.path.join(script_dir,'settings')))
+    if not settings:
+        print('No saved settings, run slupdate.py without a command to configure it')
+        return EXIT_CONFIG
+    # builds report problems needing a manual fix instead of asking for one
+    settings['interactive'] = False
+    if args.command == 'audit':
+        report_path = os.path.join(script_dir,'chd_audit.json')
+        report = audit_chd_library(settings,list(consoles.values()),report_path,args.jobs or settings.get('audit_workers',8))
+        print_audit_summary(report)
+        return EXIT_OK
+    platforms = batch_platforms(args)
+    if platforms is None:
+        return EXIT_CONFIG
+    status = EXIT_OK
+    if args.command == 'build':
+        chdman_version = chdman_info()
+        if not chdman_version or not is_greater_than_0_176(chdman_version):
+            print('chdman is missing or outdated, please install a recent version')
+            return EXIT_CONFIG
+        if args.jobs:
+            settings['chd_workers'] = args.jobs
+    if args.command == 'update-softlist':
+        for platform in platforms:
+            changed = collect_built_sha1s(platform)
+            print(f'{platform}: {changed} CHD hash(es) differ from the softlist')
+            if changed and args.yes:
+                update_softlist_chd_sha1s(settings['sl_dir']+os.sep+platform+'.xml',softlist_dict[platform])
+        return status
+    if len(platforms) > 1:
+        summaries = map_all_function(platforms)
+    else:
+        automap_function(platforms[0])
+        summaries = {platforms[0] : True}
+    if None in summaries.values():
+        status = EXIT_FAILED
+    if args.command == 'build':
+        for platform in platforms:
+            if summaries[platform] is None:
+                continue
+            results = chd_builder(platform, confirm=args.update_softlist)
+            if results is None:
+                return EXIT_CONFIG
+            if any(result['error'] for result in results):
+                status = EXIT_FAILED
+    return status
+
+
 if __name__ == '__main__':
 
+    if len(sys.argv) > 1:
+        sys.exit(batch_main(sys.argv[1:]))
+
     if len(settings) == 0:
         # walk through all the mandatory settings one by one on the first run
         first_run()